@@ -4,6 +4,9 @@
 """
 force: returns force
 force_and_grad: puts the forces in cache, the Nx3 grad in the grad vector. Zeros cache, doesn't modify grad, returns magnitude of pair-wise distnace vector
+force_sparse: returns (start, values), the basis values which are non-zero starting at mesh index start
+force_dot: returns the force (w dot basis) at each of an array of distances
+potential_dot: returns the potential (w dot basis) at each of an array of distances, optionally summing the basis potentials into a gradient
 
 """
 
@@ -35,6 +38,12 @@ class UnitStep(object):
         assert i < len(mesh), "Attempted calculation outside of mesh. {} is beyond [{},{}]. Index = {} ( > {})".format(x, mesh.min(), mesh.max(), i, len(mesh))
         cache[mesh.mesh_index(x)] = 1                        
 
+    @staticmethod
+    def force_sparse(FTYPE_t x, mesh):
+        i = mesh.mesh_index(x)
+        assert i < len(mesh), "Attempted calculation outside of mesh. {} is beyond [{},{}]. Index = {} ( > {})".format(x, mesh.min(), mesh.max(), i, len(mesh))
+        return i, np.ones(1, dtype=FTYPE)
+
     @staticmethod
     def potential(FTYPE_t x, mesh):
         cdef int i, lm
@@ -45,54 +54,39 @@ class UnitStep(object):
             result[i] = (mesh[i + 1] - mesh[i])
         return -result
 
+    @staticmethod
+    def force_dot(x, w, mesh):
+        #only one basis function is non-zero, so just gather the weights
+        return np.asarray(w, dtype=FTYPE)[mesh.mesh_indices(x)]
 
-cdef class Quartic(object):
+    @staticmethod
+    def potential_dot(x, w, mesh, grad = None):
+        lm = len(mesh)
+        index = mesh.mesh_indices(x)
+        widths = np.asarray([mesh[i + 1] - mesh[i] for i in range(lm)], dtype=FTYPE)
+        #the potential of a bin is non-zero from its left edge to the end of the mesh
+        tail = np.zeros(lm + 1, dtype=FTYPE)
+        tail[:-1] = np.cumsum((widths * w)[::-1])[::-1]
+        if(grad is not None):
+            grad -= widths * np.cumsum(np.bincount(index, minlength=lm))
+        return -tail[index]
+
+
+cdef class CompactBasis(object):
+    """A basis whose functions are only non-zero within basis_n mesh
+       points of the mesh point containing x. Subclasses define the
+       basis function and its integral.
+    """
 
     #The number of non-zero neighbor bins which must be evaluated 
     cdef int basis_n
-    #inverse of the width, needed for scaling
-    cdef FTYPE_t inv_width 
 
-    def __init__(self, mesh = None, width = None, *pickle_args):
-        """ Construct a Quartic basis.  The mesh must be given so that
-            the Quartice mesh can optimize its layout on the mesh. The
-            width should be from the left edge to right edge of the basis
-        """
+    #overridden by subclasses
+    cdef FTYPE_t _basis(self, FTYPE_t x, FTYPE_t left_edge):
+        return 0
  
-        #only works on uniform mesh
-        if(mesh):
-            assert type(mesh) is UniformMesh, "Quartic basis only works on uniform mesh currently and not %s" % type(mesh)
-
-            self.basis_n = 0
-
-            if(width is None or width < mesh.dx * 1.5):
-                width = mesh.dx * 1.5
-
-            #count neighbor non-zero bins in addition to main bin
-            self.basis_n = <int> ceil(width / mesh.dx)
-        
-            self.inv_width = (2. / width)
-        #check for pickling
-        else:            
-            self.basis_n = pickle_args[0]
-            self.inv_width = pickle_args[1]
-
-        
-    cdef inline FTYPE_t _basis(self, FTYPE_t x, FTYPE_t left_edge):
-        #Assumes we're given the left edge, instead of center, hence -1       
-        x = self.inv_width * (x - left_edge) - 1
-        if(abs(x) >= 1):
-            return 0
-        return (15. / 16.) * (1. - x * x)  * (1. - x * x) 
-
-    cdef inline FTYPE_t _int_basis(self, FTYPE_t x, FTYPE_t left_edge):
-        #Assumes we're given the left edge, instead of center, hence -1
-        x = self.inv_width * (x - left_edge) - 1
-        if(x < -1):
-            return 1
-        elif(x > 1):
-            return 0
-        return -1. / 16. * (x - 1)**3 * (3 * x**2 + 9 * x + 8)
+    cdef FTYPE_t _int_basis(self, FTYPE_t x, FTYPE_t left_edge):
+        return 0
         
     def force(self, FTYPE_t x, mesh):
         result = np.zeros(len(mesh), dtype=FTYPE)
@@ -112,6 +106,19 @@ cdef class Quartic(object):
         #downwards on mesh
         for i in range(index - 1, max(-1, index - self.basis_n - 1), -1):
             cache[i] = self._basis(x, mesh.cgetitem(i))
+
+    cpdef force_sparse(self, FTYPE_t x, mesh):
+        """Returns (start, values) where values are the non-zero
+           entries of force_cache, beginning at mesh index start
+        """
+        cdef int index = mesh.mesh_index(x)
+        cdef int start = max(0, index - self.basis_n)
+        cdef int end = min(len(mesh), index + self.basis_n + 1)
+        cdef np.ndarray[FTYPE_t, ndim=1] values = np.empty(end - start, dtype=FTYPE)
+        cdef int i
+        for i in range(start, end):
+            values[i - start] = self._basis(x, mesh.cgetitem(i))
+        return start, values
         
 
     cpdef np.ndarray[FTYPE_t, ndim=1] potential(self, FTYPE_t x, mesh):
@@ -128,16 +135,111 @@ cdef class Quartic(object):
             result[i] = mesh.dx * self._int_basis(x, mesh.cgetitem(i))
         return -result
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def force_dot(self, x, FTYPE_t[::1] w, mesh):
+        cdef np.ndarray[np.int32_t, ndim=1] index = mesh.mesh_indices(x)
+        cdef FTYPE_t[::1] xf = np.ascontiguousarray(x, dtype=FTYPE)
+        cdef np.ndarray[FTYPE_t, ndim=1] result = np.zeros(len(xf), dtype=FTYPE)
+        cdef FTYPE_t l = mesh.min()
+        cdef FTYPE_t dx = mesh.dx
+        cdef int lm = len(mesh)
+        cdef int i, k
+        for k in range(len(xf)):
+            for i in range(max(0, index[k] - self.basis_n), min(lm, index[k] + self.basis_n + 1)):
+                result[k] += w[i] * self._basis(xf[k], i * dx + l)
+        return result
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def potential_dot(self, x, FTYPE_t[::1] w, mesh, grad = None):
+        cdef np.ndarray[np.int32_t, ndim=1] index = mesh.mesh_indices(x)
+        cdef FTYPE_t[::1] xf = np.ascontiguousarray(x, dtype=FTYPE)
+        cdef np.ndarray[FTYPE_t, ndim=1] result = np.empty(len(xf), dtype=FTYPE)
+        cdef FTYPE_t l = mesh.min()
+        cdef FTYPE_t dx = mesh.dx
+        cdef int lm = len(mesh)
+        cdef int i, k, maxb
+        cdef FTYPE_t b
+        cdef bint do_grad = grad is not None
+        cdef FTYPE_t[::1] g
+        #beyond the basis the potential is a constant dx, so sum those with the tail of w
+        cdef np.ndarray[FTYPE_t, ndim=1] tail = np.zeros(lm + 1, dtype=FTYPE)
+        tail[:lm] = np.flipud(np.cumsum(np.flipud(np.asarray(w))))
+        #number of pairs whose constant part starts at each mesh point
+        cdef np.ndarray[np.int32_t, ndim=1] starts = np.zeros(lm + 1, dtype=np.int32)
+        if(do_grad):
+            g = grad
+
+        for k in range(len(xf)):
+            maxb = min(lm - 1, index[k] + self.basis_n)
+            result[k] = dx * tail[maxb + 1]
+            starts[maxb + 1] += 1
+            for i in range(max(0, index[k] - self.basis_n), maxb + 1):
+                b = dx * self._int_basis(xf[k], i * dx + l)
+                result[k] += w[i] * b
+                if(do_grad):
+                    g[i] -= b
+
+        if(do_grad):
+            grad -= dx * np.cumsum(starts[:lm])
+        return -result
+
+
+cdef class Quartic(CompactBasis):
+
+    #inverse of the width, needed for scaling
+    cdef FTYPE_t inv_width
+
+    def __init__(self, mesh = None, width = None, *pickle_args):
+        """ Construct a Quartic basis.  The mesh must be given so that
+            the Quartice mesh can optimize its layout on the mesh. The
+            width should be from the left edge to right edge of the basis
+        """
+
+        #only works on uniform mesh
+        if(mesh):
+            assert type(mesh) is UniformMesh, "Quartic basis only works on uniform mesh currently and not %s" % type(mesh)
+
+            self.basis_n = 0
+
+            if(width is None or width < mesh.dx * 1.5):
+                width = mesh.dx * 1.5
+
+            #count neighbor non-zero bins in addition to main bin
+            self.basis_n = <int> ceil(width / mesh.dx)
+
+            self.inv_width = (2. / width)
+        #check for pickling
+        else:
+            self.basis_n = pickle_args[0]
+            self.inv_width = pickle_args[1]
+
+
+    cdef FTYPE_t _basis(self, FTYPE_t x, FTYPE_t left_edge):
+        #Assumes we're given the left edge, instead of center, hence -1
+        x = self.inv_width * (x - left_edge) - 1
+        if(abs(x) >= 1):
+            return 0
+        return (15. / 16.) * (1. - x * x)  * (1. - x * x)
+
+    cdef FTYPE_t _int_basis(self, FTYPE_t x, FTYPE_t left_edge):
+        #Assumes we're given the left edge, instead of center, hence -1
+        x = self.inv_width * (x - left_edge) - 1
+        if(x < -1):
+            return 1
+        elif(x > 1):
+            return 0
+        return -1. / 16. * (x - 1)**3 * (3 * x**2 + 9 * x + 8)
+
     def __reduce__(self):
         return Quartic, (None, None, self.basis_n, self.inv_width)
 
 
 
 
-cdef class Gaussian(object):
+cdef class Gaussian(CompactBasis):
 
-    #The number of non-zero neighbor bins which must be evaluated 
-    cdef int basis_n
     #gaussian sigma inverse
     cdef FTYPE_t inv_sigma
 
@@ -166,14 +268,14 @@ cdef class Gaussian(object):
             self.inv_sigma = pickle_args[1]
 
         
-    cdef inline FTYPE_t _basis(self, FTYPE_t x, FTYPE_t left_edge):
+    cdef FTYPE_t _basis(self, FTYPE_t x, FTYPE_t left_edge):
 
         x = self.inv_sigma * (x - left_edge) - 0.5
         if(abs(x) >= 3.5):
             return 0
         return 1 / sqrt(2 * pi) * exp(-0.5 * x ** 2)
 
-    cdef inline FTYPE_t _int_basis(self, FTYPE_t x, FTYPE_t left_edge):
+    cdef FTYPE_t _int_basis(self, FTYPE_t x, FTYPE_t left_edge):
 
         x = self.inv_sigma * (x - left_edge) - 0.5
         if(x < -3.5):
@@ -182,40 +284,5 @@ cdef class Gaussian(object):
             return 0
         return 1 - (0.5  + 0.5 * erf(x / sqrt(2.)))
         
-    def force(self, FTYPE_t x, mesh):
-        result = np.zeros(len(mesh), dtype=FTYPE)
-        self.force_cache(x, result, mesh)
-        return result
-
-    cpdef force_cache(self, FTYPE_t x, np.ndarray[FTYPE_t, ndim=1] cache, mesh):
-        cache.fill(0)
-        cdef int index = mesh.mesh_index(x)
-        
-        cache[index] = self._basis(x, mesh.cgetitem(index))
-
-        cdef int i
-        #upwards on mesh
-        for i in range(index + 1, min(len(mesh), index + self.basis_n + 1)):
-            cache[i] = self._basis(x, mesh.cgetitem(i))
-        #downwards on mesh
-        for i in range(index - 1, max(-1, index - self.basis_n - 1), -1):
-            cache[i] = self._basis(x, mesh.cgetitem(i))
-        
-
-    cpdef np.ndarray[FTYPE_t, ndim=1] potential(self, FTYPE_t x, mesh):
-        cdef int i, lm, maxb
-        lm = len(mesh)
-
-        result = np.zeros(lm, dtype=FTYPE)
-        mesh_point = mesh.mesh_index(x)        
-        maxb = min(lm - 1, mesh_point + self.basis_n) # the point at which we must evaluate numerically
-
-        for i in range(lm - 1, maxb, -1):
-            result[i] = mesh.dx
-        for i in range(maxb, max(-1, mesh_point - self.basis_n - 1), -1):
-            result[i] = mesh.dx * self._int_basis(x, mesh.cgetitem(i))
-        return -result
-
     def __reduce__(self):
         return Gaussian, (None, None, self.basis_n, self.inv_sigma)
-
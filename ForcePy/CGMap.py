@@ -5,8 +5,9 @@ from MDAnalysis.core.units import get_conversion_factor
 import MDAnalysis.coordinates.base as base
 import numpy as np
 import scipy.sparse as npsp
-from ForcePy.ForceMatch import same_img
-import os
+from ForcePy.Util import same_img_array
+from ForcePy.LammpsDump import LammpsDump
+import os, json
 import ForcePy.ForceCategories as ForceCategories
 
 
@@ -45,7 +46,7 @@ class CGUniverse(Universe):
         self.residue_reduction_map = residue_reduction_map
 
         if(lammps_force_dump):
-            self.lfdump = open(lammps_force_dump, 'r')
+            self.lfdump = LammpsDump(lammps_force_dump)
         else:
             self.lfdump = None
 
@@ -195,10 +196,15 @@ class CGUniverse(Universe):
     def trajectory(self):
         return self.__trajectory
 
-    def cache(self, directory='cg_cache'):
+    def cache(self, directory='cg_cache', mmap=False):
         '''This precomputes the trajectory and structure so that it doesn't need to be 
            recalculated at each timestep. Especially useful for random access.
            Returns a Universe object corresponding to the cached trajectory
+
+           If mmap is True, the positions, forces and boxes are stored
+           as numpy arrays which the returned Universe memory-maps. This
+           skips decoding the trajectory, and processes reading the same
+           cache share its pages. Reload it later with load_cache.
         '''
 
         if(not os.path.exists(directory)):
@@ -206,6 +212,9 @@ class CGUniverse(Universe):
         structure = os.path.join(directory, 'cg.pdb')
         trajectory = os.path.join(directory, 'cg.trr')
         write_structure(self, structure, bonds='all')
+        if(mmap):
+            write_mmap_trajectory(self, directory)
+            return load_cache(directory)
         write_trajectory(self, trajectory)        
         u = Universe(structure, trajectory)
         u.trajectory.periodic = self.trajectory.periodic
@@ -236,6 +245,13 @@ class CGReader(base.Reader):
         self.force_map = force_map
         
         self.lfdump = lfdump
+        #set by ForceMatch.profile to time the mapping
+        self.profiler = None
+
+        #each atom is put into the same periodic image as the first atom of its residue
+        self.img_anchor = np.arange(aatraj.numatoms, dtype=np.int32)
+        for r in self.u.ref_u.residues:
+            self.img_anchor[[a.number for a in r.atoms]] = r.atoms[0].number
 
         self.units = aatraj.units
         self.numatoms = np.shape( top_map )[0] #The topology matrix mapping should have a number of rows equal to cg atoms
@@ -263,19 +279,25 @@ class CGReader(base.Reader):
                 except IOError: raise StopIteration
         return iterCG()
 
+    def __getitem__(self, frame):
+        '''Jumps to the given frame, counting from 0. The lammps force
+           dump, if any, is seeked with its frame offset index.
+        '''
+        ts = self.aatraj[frame]
+        if(self.lfdump):
+            self.lfdump.seek(frame)
+        return self._read_next_timestep(ts=ts)
+
     def _read_next_timestep(self, ts=None):
         if(ts is None):
             ts = self.aatraj.next()
+        if(self.profiler):
+            self.profiler.start('cg_map')
         self.ts.frame = ts.frame        
 
-        #now, we must painstakingly and annoyingly put each cg group into the same periodic image
-        #as its residue 
+        #now, we must put each cg group into the same periodic image as its residue 
         if(self.aatraj.periodic):
-
-            for r in self.u.ref_u.residues:
-                centering_vector = np.copy(r.atoms[0].pos)
-                for a in r.atoms:
-                    a.pos[:] =  same_img(a.pos[:], centering_vector, ts.dimensions)
+            same_img_array(ts._pos, self.img_anchor, np.asarray(ts.dimensions[:3], dtype=np.float32))
                                             
         self.ts._pos = self.top_map.dot( ts._pos )
         try:
@@ -287,15 +309,7 @@ class CGReader(base.Reader):
         if(self.lfdump):
             #we do, let's read it
             forces = np.zeros( (np.shape(self.top_map)[1], 3), dtype=np.float32)
-            while(not self.lfdump.readline().startswith('ITEM: ATOMS')):
-                pass
-            for i in range(len(forces)):
-                sline = self.lfdump.readline().split()
-                    #NOTE NOTE NOTE NOTE: Lammps forces seem to be negative of what I use.
-                try:
-                    forces[int(sline[0]) - 1,:] = [-float(x) for x in sline[1:]]                        
-                except ValueError:
-                    raise IOError( 'Invalid forces line at %s' % reduce(lambda x,y: x + ' ' + y, sline))
+            self.lfdump.read_forces(forces)
             self.ts._forces[:] = self.force_map.dot( forces) 
         else:
             try:
@@ -304,10 +318,84 @@ class CGReader(base.Reader):
                 #can't find any forces, use 0
                 self.ts._forces[:] = np.zeros( (self.numatoms, 3) ,dtype=np.float32)
 
+        if(self.profiler):
+            self.profiler.stop('cg_map')
         return self.ts
 
     def rewind(self):
         self.aatraj.rewind()
+        #the all-atom reader is left on its first frame, so map that one
+        if(self.lfdump):
+            self.lfdump.rewind()
+        self._read_next_timestep(ts=self.aatraj.ts)
+
+
+class MMapTimestep(Timestep):
+
+    @property
+    def dimensions(self):
+        #_unitcell is in the charmm ordering, which is what ForceMatch sets when overriding the box
+        uc = self._unitcell
+        return np.array([uc[0], uc[2], uc[5], uc[4], uc[3], uc[1]], dtype=np.float32)
+
+class MMapReader(base.Reader):
+    '''Serves frames from the memory-mapped arrays written by
+       write_mmap_trajectory. The cache is opened read-only, so each
+       frame is copied into the timestep's own arrays.
+    '''
+
+    format = 'NPY'
+
+    def __init__(self, directory, periodic = True, units = None):
+        self.filename = directory
+        self.positions = np.load(os.path.join(directory, 'positions.npy'), mmap_mode='r')
+        self.forces = np.load(os.path.join(directory, 'forces.npy'), mmap_mode='r')
+        self.boxes = np.load(os.path.join(directory, 'boxes.npy'), mmap_mode='r')
+        self.numframes, self.numatoms = np.shape(self.positions)[:2]
+        self.periodic = periodic
+        self.units = units
+        self.skip = 1
+        self.ts = MMapTimestep(self.numatoms)
+        self.ts._pos = np.empty( (self.numatoms, 3), dtype=np.float32)
+        self.ts._forces = np.empty( (self.numatoms, 3), dtype=np.float32)
+        self.ts._velocities = np.zeros( (self.numatoms, 3), dtype=np.float32)
+        self.current = 0
+        self._read_frame(0)
+
+    def _read_frame(self, frame):
+        self.current = frame
+        #frames count from 1, as in the MDAnalysis readers
+        self.ts.frame = frame + 1
+        self.ts._pos[:] = self.positions[frame]
+        self.ts._forces[:] = self.forces[frame]
+        box = self.boxes[frame]
+        self.ts._unitcell = np.array([box[0], box[5], box[1], box[4], box[3], box[2]], dtype=np.float32)
+        return self.ts
+
+    def __len__(self):
+        return self.numframes
+
+    def __getitem__(self, frame):
+        if(frame < 0):
+            frame += self.numframes
+        if(frame < 0 or frame >= self.numframes):
+            raise IndexError('Frame %d is outside of the %d cached frames' % (frame, self.numframes))
+        return self._read_frame(frame)
+
+    def __iter__(self):
+        for i in range(self.numframes):
+            yield self._read_frame(i)
+
+    def next(self):
+        if(self.current + 1 >= self.numframes):
+            raise IOError('Reached the end of the cached trajectory')
+        return self._read_frame(self.current + 1)
+
+    def rewind(self):
+        self._read_frame(0)
+
+    def close(self):
+        pass
 
 #END CGUniverse Stuff
 
@@ -539,6 +627,47 @@ def write_trajectory(universe, filename):
         w.write(ts)
     w.close()
 
+def write_mmap_trajectory(universe, directory):
+    '''Writes the positions, forces and boxes of every frame as numpy
+       arrays in directory, along with the metadata needed by load_cache
+    '''
+    frames = universe.trajectory.numframes
+    N = universe.atoms.numberOfAtoms()
+    positions = np.lib.format.open_memmap(os.path.join(directory, 'positions.npy'), mode='w+', dtype=np.float32, shape=(frames, N, 3))
+    forces = np.lib.format.open_memmap(os.path.join(directory, 'forces.npy'), mode='w+', dtype=np.float32, shape=(frames, N, 3))
+    boxes = np.lib.format.open_memmap(os.path.join(directory, 'boxes.npy'), mode='w+', dtype=np.float32, shape=(frames, 6))
+    #iterating a CGReader continues from its current frame, so start from the first one
+    universe.trajectory.rewind()
+    ts = universe.trajectory.ts
+    written = 0
+    try:
+        while(written < frames):
+            if(written > 0):
+                ts = universe.trajectory.next()
+            positions[written] = ts._pos
+            forces[written] = ts._forces
+            boxes[written] = ts.dimensions
+            written += 1
+    except (IOError, StopIteration):
+        pass
+    del positions, forces, boxes
+    assert written == frames, 'Only %d of the %d frames could be read for the cache' % (written, frames)
+
+    with open(os.path.join(directory, 'cg.json'), 'w') as f:
+        json.dump({'periodic':universe.trajectory.periodic, 
+                   'units':universe.trajectory.units,
+                   'mass_map':create_mass_map(universe)}, f)
+
+def load_cache(directory='cg_cache'):
+    '''Loads a Universe from a cache written by CGUniverse.cache(mmap=True)
+    '''
+    with open(os.path.join(directory, 'cg.json'), 'r') as f:
+        meta = json.load(f)
+    u = Universe(os.path.join(directory, 'cg.pdb'))
+    u.trajectory = MMapReader(directory, meta['periodic'], meta['units'])
+    apply_mass_map(u, meta['mass_map'])
+    return u
+
 def create_mass_map(universe):
     '''Create a map of masses for atom types in a universe so that they can be applied to a universe without masses assigned
        to atoms. This is useful if writing a universe with a format that doesn't include masses (gro, pdb).
@@ -1,6 +1,16 @@
 from ForcePy.NeighborList import NeighborList
 import numpy as np
-from ForcePy.Util import norm3, min_img_vec
+from ForcePy.Util import neighbor_vecs
+
+def atom_type_ids(u):
+    """Returns the atom types of u in order of first appearance and
+       an array with the index into them of each atom's type
+    """
+    index = {}
+    ids = np.empty(u.atoms.numberOfAtoms(), dtype=np.int32)
+    for k,a in enumerate(u.atoms):
+        ids[k] = index.setdefault(a.type, len(index))
+    return sorted(index, key=index.get), ids
 
 class ForceCategory(object):
     """A category of force/potential type.
@@ -13,24 +23,139 @@ class ForceCategory(object):
 
     def __init__(self):
         self.nlist_ready = False
+        self.positions = None
+        self.pairs = None
+        self.masked_pairs = {}
+        self.types = None
+        self.type_ids = None
+        self.types_key = None
 
-    def generate_nlist(self, i):
+    #pairs farther than this are dropped when computing neighbor vectors. 0 keeps all pairs
+    pair_cutoff = 0
+
+    def _load_frame(self, u):
+        """Cache the positions and box of the current frame, which are
+           shared by every force using this category
+        """
+        if(self.positions is None):
+            self.positions = np.ascontiguousarray(u.atoms.get_positions(), dtype=np.float32)
+            self.dims = np.asarray(u.trajectory.ts.dimensions[:3], dtype=np.float32)
+            self.periodic = u.trajectory.periodic
+
+    def _load_pairs(self, u):
+        """Compute the vectors of every pair in the neighbor list for
+           the frame. They are shared by every force using this
+           category until _teardown
+        """
+        if(self.pairs is None):
+            self._load_frame(u)
+            pairs = neighbor_vecs(self.positions, self.dims, self.periodic, self.nlist, self.nlist_offsets,
+                                  0, len(self.nlist_lengths), self.pair_cutoff)
+            #pairs are in order of i, so the pairs of i are pairs[offsets[i]:offsets[i + 1]]
+            self.pairs = pairs + (np.searchsorted(pairs[0], np.arange(len(self.nlist_lengths) + 1)),)
+            #the pairs selected by each pair of type masks, keyed by their ids
+            self.masked_pairs = {}
+
+    def _masked_pairs(self, mask1, mask2):
+        key = (id(mask1), id(mask2))
+        if(key not in self.masked_pairs):
+            ii, jj, r, d, offsets = self.pairs
+            m1 = np.asarray(mask1, dtype=np.bool_)
+            m2 = m1 if mask2 is None else np.asarray(mask2, dtype=np.bool_)
+            if(m1.all() and m2.all()):
+                #masks covering every atom select every pair, so skip the copies
+                pairs = (ii, jj, r, d, offsets)
+            else:
+                #j is checked against mask2 if i is in mask1, otherwise i must be in mask2 and j in mask1
+                keep = np.where(m1[ii], m2[jj], m2[ii] & m1[jj])
+                offsets = np.concatenate(([0], np.cumsum(keep)))[offsets]
+                pairs = (ii[keep], jj[keep], r[keep], d[keep], offsets)
+            #the masks are kept so their ids aren't reused during the frame
+            self.masked_pairs[key] = pairs + (mask1, mask2)
+        return self.masked_pairs[key][:5]
+
+    def _load_types(self, u):
+        """Cache the type id of every atom, which index self.types
+        """
+        #keyed by id so the category doesn't hold on to the universe
+        if(self.types_key != id(u)):
+            self.types, self.type_ids = atom_type_ids(u)
+            self.types_key = id(u)
+        return self.type_ids
+
+    def type_mask(self, u, type_name):
+        """Boolean mask of the atoms with the given type
+        """
+        ids = self._load_types(u)
+        if(type_name not in self.types):
+            return np.zeros(len(ids), dtype=np.bool_)
+        return ids == self.types.index(type_name)
+
+    def type_table(self, u, forces):
+        """Returns a table indexed by the type ids of the two atoms in
+           a pair, giving the index of the force in forces which acts
+           on that pair or -1. The first force without type
+           specialization acts on any pair not taken by another.
+        """
+        self._load_types(u)
+        table = -np.ones( (len(self.types), len(self.types)), dtype=np.int32)
+        general = -1
+        for k,f in enumerate(forces):
+            sel1 = getattr(f, 'sel1', None)
+            sel2 = getattr(f, 'sel2', None)
+            if(sel1 is None):
+                general = k if general == -1 else general
+                continue
+            if(sel2 is None):
+                sel2 = sel1
+            if(sel1 in self.types and sel2 in self.types):
+                t1, t2 = self.types.index(sel1), self.types.index(sel2)
+                table[t1, t2] = table[t2, t1] = k
+        table[table == -1] = general
+        return table
+
+    def _build_nlist_offsets(self):
+        """Prefix sum of the neighbor list lengths, so that the
+           neighbors of i are nlist[nlist_offsets[i]:nlist_offsets[i + 1]]
+        """
+        self.nlist_offsets = np.zeros(len(self.nlist_lengths) + 1, dtype=np.int32)
+        np.cumsum(self.nlist_lengths, out=self.nlist_offsets[1:])
+
+    def neighbors(self, i):
+        """Returns a view into the neighbor list of the neighbors of i
+        """
         assert self.nlist_ready, "Neighbor list not built yet"
-        nlist_accum = np.sum(self.nlist_lengths[:i]) if i > 0  else 0
-        for j in self.nlist[nlist_accum:(nlist_accum + self.nlist_lengths[i])]:
+        return self.nlist[self.nlist_offsets[i]:self.nlist_offsets[i + 1]]
+
+    def generate_nlist(self, i):
+        for j in self.neighbors(i):
             yield j
 
-    def generate_neighbor_vecs(self, i, u, mask = None):
-        positions = u.atoms.get_positions()
-        dims = u.trajectory.ts.dimensions
+    def neighbor_vecs(self, u, mask1 = None, mask2 = None, i = None):
+        """Returns arrays (i, j, r, d) with an entry for each pair in
+           the neighbor list, where r is the unit vector from i to j and
+           d is their distance. This is over the whole frame, or only
+           the neighbors of i if it is given. The masks select pairs the
+           same way as Force type masks.
+        """
+        assert self.nlist_ready, "Neighbor list not built yet"
+        self._load_pairs(u)
+        if(mask1 is None):
+            ii, jj, r, d, offsets = self.pairs
+        else:
+            ii, jj, r, d, offsets = self._masked_pairs(mask1, mask2)
+        if(i is None):
+            return ii, jj, r, d
+        lo, hi = offsets[i], offsets[i + 1]
+        return ii[lo:hi], jj[lo:hi], r[lo:hi], d[lo:hi]
 
-        for j in self.generate_nlist(i):
-            if(mask and not mask[j]):
-                continue
-            r = min_img_vec(positions[j], positions[i], dims, u.trajectory.periodic)
-            d = norm3(r)
-            r = r / d
-            yield (r,d,j)
+    def generate_neighbor_vecs(self, i, u, mask = None):
+        ii, jj, r, d = self.neighbor_vecs(u, i=i)
+        if(mask is not None):
+            keep = np.asarray(mask, dtype=np.bool_)[jj]
+            jj, r, d = jj[keep], r[keep], d[keep]
+        for k in range(len(jj)):
+            yield (r[k], d[k], jj[k])
 
         
 
@@ -58,25 +183,46 @@ class Pairwise(ForceCategory):
                 raise RuntimeError("Incompatible cutoffs: Already set to %g, not %g" % (Pairwise.instance.cutoff,args[0]))
         return Pairwise.instance
     
-    def __init__(self, cutoff=12):
+    def __init__(self, cutoff=12, skin=0):
         super(Pairwise, self).__init__()
         self.cutoff = cutoff                    
+        self.skin = skin
         self.forces = []
         self.nlist_obj = None
 
+    def set_skin(self, skin):
+        """Use a Verlet skin for the neighbor list. The list is built
+           out to cutoff + skin and only rebuilt when a particle has
+           moved more than skin / 2, so densely sampled trajectories
+           skip most rebuilds.
+        """
+        self.skin = skin
+        self.nlist_obj = None
+        self.nlist_ready = False
+
+    @property
+    def pair_cutoff(self):
+        #the list may hold skin pairs which are beyond the cutoff
+        return self.cutoff if self.skin > 0 else 0
+
     def _build_nlist(self, u):
         if(self.nlist_obj is None):
-            self.nlist_obj = NeighborList(u, self.cutoff)
+            self.nlist_obj = NeighborList(u, self.cutoff, skin=self.skin)
         self.nlist, self.nlist_lengths = self.nlist_obj.build_nlist(u)
+        self._build_nlist_offsets()
 
         self.nlist_ready = True                    
 
     def _setup(self, u):
         if(not self.nlist_ready):
             self._build_nlist(u)
+        self._load_pairs(u)
 
     def _teardown(self):
         self.nlist_ready = False
+        self.positions = None
+        self.pairs = None
+        self.masked_pairs = {}
 
     def pair_exists(self, u, type1, type2):
         return True
@@ -99,8 +245,8 @@ class Bond(ForceCategory):
 
     def _build_nlist(self, u):
         temp = [[] for x in range(u.atoms.numberOfAtoms())]
-        #could be at most everything bonded with everything
-        self.nlist = np.empty((u.atoms.numberOfAtoms() - 1) * (u.atoms.numberOfAtoms() / 2), dtype=np.int32)
+        #each bond appears twice
+        self.nlist = np.empty(2 * len(u.bonds), dtype=np.int32)
         self.nlist_lengths = np.empty(u.atoms.numberOfAtoms(), dtype=np.int32)
         nlist_accum = 0
         for b in u.bonds:
@@ -114,16 +260,19 @@ class Bond(ForceCategory):
                 self.nlist[nlist_accum] = b
                 nlist_accum += 1
 
-        #resize now we know how many bond items there are
-        self.nlist = self.nlist[:nlist_accum]
+        self._build_nlist_offsets()
         self.nlist_ready = True
 
     def _setup(self, u):
         if(not self.nlist_ready):
             self._build_nlist(u)
+        self._load_pairs(u)
 
     def _teardown(self):
         self.nlist_ready = False
+        self.positions = None
+        self.pairs = None
+        self.masked_pairs = {}
         
     def pair_exists(self, u, type1, type2):
         """Check to see if a there exist any pairs of the two types given
@@ -133,9 +282,7 @@ class Bond(ForceCategory):
 
         sel2 = u.atoms.selectAtoms(type2)        
         for a in u.atoms.selectAtoms(type1):
-            i = a.number
-            nlist_accum = np.sum(self.nlist_lengths[:i]) if i > 0  else 0
-            for j in self.nlist[nlist_accum:(nlist_accum + self.nlist_lengths[i])]:
+            for j in self.neighbors(a.number):
                 if(u.atoms[int(j)] in sel2):
                     return True
 
@@ -1,4 +1,5 @@
-import random, os, json
+import random, os, json, time
+import multiprocessing
 import numpy as np
 import numpy.linalg as ln
 from math import ceil
@@ -15,7 +16,9 @@ except ImportError as e:
     
 from ForcePy.Util import *
 from ForcePy.ForceCategories import *
-from ForcePy.CGMap import CGUniverse, apply_mass_map, create_mass_map, write_lammps_data
+from ForcePy.CGMap import CGUniverse, MMapReader, apply_mass_map, create_mass_map, write_lammps_data, load_cache
+from ForcePy.Profiler import Profiler
+from ForcePy.FrameIndex import XYZIndex
 try:
     from mpi4py import MPI
     mpi_support = True
@@ -23,6 +26,37 @@ except ImportError as e:
     mpi_support = False
     mpi_error = e
 
+#state inherited by the forked workers of force_match_parallel
+_parallel_state = {}
+
+def _parallel_init():
+    fm = _parallel_state['fm']
+    #forked workers inherit the parent's random state and would all sample the same frames
+    seed = (os.getpid() ^ int(time.time() * 1000)) & 0xffffffff
+    random.seed(seed)
+    np.random.seed(seed)
+    #forked workers share the parent's file offsets, so each needs its own trajectory reader
+    if(type(fm.u.trajectory) != MMapReader):
+        periodic = fm.u.trajectory.periodic
+        fm.u.load_new(fm.u.trajectory.filename)
+        fm.u.trajectory.periodic = periodic
+        fm.frame_index = None
+
+def _parallel_task(args):
+    slot, start, end, do_print, minibatch = args
+    fm = _parallel_state['fm']
+    params = np.ctypeslib.as_array(_parallel_state['params'])
+    results = np.ctypeslib.as_array(_parallel_state['results']).reshape( (-1, len(params)) )
+
+    fm._unpack_params(params)
+    try:
+        fm._force_match_task(start, end, do_print, minibatch)
+    except (EOFError, IOError):
+        #just finished reading the file, eat the exception
+        pass
+    fm._pack_params(results[slot])
+    return slot
+
 
 class ForceMatch:
     """Main force match class.
@@ -45,6 +79,13 @@ class ForceMatch:
         self.tar_force_buffer = None
         self.send_buffer = None
         self.rec_buffer = None
+        self.reduce_request = None
+        self.work_window = None
+        self.profiler = None
+        self.frame_pairs = 0
+        #random access into xyz trajectories, see _seek_ts
+        self.frame_index = None
+        self.indexed_frame = None
 
 
     
@@ -91,6 +132,11 @@ class ForceMatch:
         odict = self.__dict__.copy()
         #remove universe, we don't want to serialize all that
         del odict['u']
+        #nor the MPI window of the work queue or the profiler, which may hold a stream
+        odict['work_window'] = None
+        odict['profiler'] = None
+        odict['frame_index'] = None
+        odict['indexed_frame'] = None
         
         if(type(self.u ) == CGUniverse):
             raise ValueError("Cannot pickle a CGUniverse. cache() must be called on it to convert to Universe")
@@ -100,12 +146,22 @@ class ForceMatch:
         odict['trajectory_filename'] = self.u.trajectory.filename
         odict['mass_map'] = create_mass_map(self.u)
         odict['trajectory_is_periodic'] = self.u.trajectory.periodic
+        odict['trajectory_is_mmap'] = type(self.u.trajectory) == MMapReader
 
         return odict
         
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        #a reduction in flight can't be restored
+        self.reduce_request = None
+        self.work_window = None
+        self.profiler = None
+        self.frame_index = None
+        self.indexed_frame = None
         #reconstruct the universe
+        if(dict.get('trajectory_is_mmap', False)):
+            self.u = load_cache(dict['trajectory_filename'])
+            return
         self.u = Universe(dict['structure_filename'], dict['trajectory_filename'])
         apply_mass_map(self.u, dict['mass_map'])
         self.u.trajectory.periodic = dict['trajectory_is_periodic']
@@ -138,7 +194,50 @@ class ForceMatch:
             for f in self.tar_forces:
                 self.cache[f] = np.copy(f.lip)
                                 
-    def force_match_mpi(self, batch_size = None, do_plots = False, repeats = 1, frame_number=0, quiet=False):
+    def profile(self, stream = None, every = 100):
+        """ Starts recording the time spent in each stage of matching,
+            along with frames and pairs per second. Returns the
+            Profiler, which can be printed or dumped to JSON. If stream
+            is given, a summary line is appended to it every `every` frames.
+        """
+        self.profiler = Profiler(stream, every)
+        if(hasattr(self.u.trajectory, 'profiler')):
+            #a CGReader also times its mapping
+            self.u.trajectory.profiler = self.profiler
+        return self.profiler
+
+    def _profile_start(self, stage):
+        if(self.profiler):
+            self.profiler.start(stage)
+
+    def _profile_stop(self, stage):
+        if(self.profiler):
+            self.profiler.stop(stage)
+
+    def _profile_frame(self):
+        if(self.profiler):
+            self.profiler.frame(self.frame_pairs)
+            self.frame_pairs = 0
+
+    def force_match_mpi(self, batch_size = None, do_plots = False, repeats = 1, frame_number=0, quiet=False, minibatch = 1, overlap = False, sync_every = 1, async_server = False, chunk_size = None, checkpoint = None, checkpoint_every = 10, resume = False):
+        """ Force matching over MPI ranks. With overlap, averaging the
+            parameters is overlapped with computing the next batch. The
+            ranks average their parameters every sync_every batches
+            (local SGD). With async_server, rank 0 instead holds the
+            parameters and merges each rank's changes as they arrive,
+            so no rank waits on the others. This needs a batch_size.
+
+            Frames are handed out to the ranks in chunks from a work
+            queue, so every frame is matched once per repeat. With
+            batch_size, each round matches one chunk of batch_size
+            frames per rank. Otherwise each repeat is one round of
+            chunk_size frame chunks.
+
+            If a checkpoint file is given, rank 0 saves the parameters
+            to it after every checkpoint_every rounds which end with
+            averaging, and with resume every rank continues after the
+            last saved round. The asynchronous server does not checkpoint.
+        """
         
         if(not mpi_support):
             raise mpi_error
@@ -155,36 +254,60 @@ class ForceMatch:
 
         frame_number = frame_number if frame_number > 0 else self.u.trajectory.numframes
 
-
-        if(batch_size):
-            index = 0
-            while(index * size * batch_size < frame_number * repeats):
-                try:
-                    self._distribute_tasks(batch_size, index * batch_size, quiet=quiet, frame_number=frame_number)
-                except (EOFError, IOError):
-                    #just finished reading the file, eat the exception. Will be rewound in force_match_task
-                    pass
-
-                self._reduce_tasks()
-                index +=1
-                if(rank == 0 and not quiet):
-                    print "%d / %d iterations" % (index * size * batch_size, frame_number * repeats)  
-                    if(do_plots):                    
-                        self._plot_forces()
-
+        if(async_server):
+            if(not batch_size):
+                raise ValueError("The asynchronous parameter server requires a batch_size")
+            self._force_match_async(batch_size, do_plots, repeats, frame_number, quiet, minibatch)
         else:
-            for i in range(repeats):
-                try:
-                    self._distribute_tasks(quiet=quiet, frame_number=frame_number)
-                except (EOFError, IOError):
-                    #just finished reading the file, eat the exception. Will be rewound in force_match_task                    
-                    pass
-                    
-                self._reduce_tasks()
+            if(batch_size):
+                #each round matches about one chunk of batch_size frames per rank
+                chunk_size = batch_size
+            elif(chunk_size is None):
+                #several chunks per rank, so the work queue can balance the load
+                chunk_size = max(1, frame_number / (4 * size))
+            epoch = [(x, min(frame_number, x + chunk_size)) for x in range(0, frame_number, chunk_size)]
+            if(batch_size):
+                tasks = epoch * repeats
+                rounds = [tasks[x:(x + size)] for x in range(0, len(tasks), size)]
+            else:
+                rounds = [epoch] * repeats
+
+            start = 0
+            if(resume):
+                start = self.load_checkpoint(checkpoint, 'force_match_mpi')
+
+            self._work_counter(len(rounds))
+            frames = 0
+            #frames matched since the throughput was last reported
+            matched = 0
+            report_start = time.time()
+            for i,chunks in enumerate(rounds):
+                if(i < start):
+                    continue
+                done = self._distribute_tasks(chunks, i, quiet=quiet, minibatch=minibatch)
+                frames += done
+                matched += done
+                #local SGD only averages every sync_every rounds, and always after the last
+                if((i + 1) % sync_every == 0 or i == len(rounds) - 1):
+                    #an overlapped reduction would wait on the gather, so then only report at the end
+                    if(not overlap or i == len(rounds) - 1):
+                        self._report_throughput(matched, time.time() - report_start, quiet)
+                        matched = 0
+                        report_start = time.time()
+                    self._reduce_tasks(overlap, frames)
+                    frames = 0
+                    if(checkpoint and ((i + 1) % checkpoint_every == 0 or i == len(rounds) - 1)):
+                        self._finish_reduce()
+                        if(rank == 0):
+                            self.save_checkpoint(checkpoint, i + 1, 'force_match_mpi')
                 if(rank == 0 and not quiet):
-                    print "%d / %d iterations" % (i+1, repeats)  
+                    print "%d / %d iterations" % (i+1, len(rounds))  
                     if(do_plots):                    
+                        self._profile_start('plot')
                         self._plot_forces()
+                        self._profile_stop('plot')
+
+        self._finish_reduce()
 
         if(rank == 0):
             print "Complete"
@@ -193,20 +316,254 @@ class ForceMatch:
 
         
 
-    def force_match(self, iterations = 0):
+    def _force_match_async(self, batch_size, do_plots, repeats, frame_number, quiet, minibatch):
+        """ Rank 0 is a parameter server, which adds each worker's
+            change in the parameters to its own as soon as it arrives
+            and replies with the merged parameters. The other ranks
+            match batches of frames without waiting on each other.
+        """
+        comm = MPI.COMM_WORLD
+        size = comm.Get_size()
+        rank = comm.Get_rank()
+        if(size < 2):
+            raise ValueError("The asynchronous parameter server needs at least one rank besides the server")
+        workers = size - 1
+        batches = int(ceil(float(frame_number * repeats) / (workers * batch_size)))
+
+        def batch(b, worker):
+            #the frames a worker, counting from rank 1, matches in its b-th batch
+            first = ((b * workers + worker - 1) * batch_size) % frame_number
+            return first, min(frame_number, first + batch_size)
+
+        #everyone starts from the parameters of rank 0
+        params = self._pack_params(np.empty( (self._param_count(),), dtype=np.float32))
+        comm.Bcast([params, MPI.FLOAT], root=0)
+        self._unpack_params(params)
+        delta = np.empty_like(params)
+
+        if(rank == 0):
+            status = MPI.Status()
+            active = workers
+            merged = 0
+            #how many batches each worker has sent
+            received = [0] * size
+            while(active > 0):
+                comm.Recv([delta, MPI.FLOAT], source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+                #scaled so that a round of every worker matches the synchronous average
+                params += delta / workers
+                merged += 1
+                #count the frames the server merged, as force_match_parallel does
+                first, last = batch(received[status.Get_source()], status.Get_source())
+                received[status.Get_source()] += 1
+                self.force_match_calls += last - first
+                if(status.Get_tag() == 2):
+                    active -= 1
+                else:
+                    comm.Send([params, MPI.FLOAT], dest=status.Get_source(), tag=1)
+                if(not quiet and merged % workers == 0):
+                    print "%d / %d batches" % (merged, batches * workers)
+                    if(do_plots):
+                        self._unpack_params(params)
+                        self._plot_forces()
+        else:
+            start = np.copy(params)
+            for b in range(batches):
+                first, last = batch(b, rank)
+                try:
+                    self._force_match_task(first, last, rank == 1 and not quiet, minibatch)
+                except (EOFError, IOError):
+                    #just finished reading the file, eat the exception
+                    pass
+                self._profile_start('reduce')
+                self._pack_params(delta)
+                delta -= start
+                if(b == batches - 1):
+                    comm.Send([delta, MPI.FLOAT], dest=0, tag=2)
+                else:
+                    comm.Send([delta, MPI.FLOAT], dest=0, tag=0)
+                    comm.Recv([start, MPI.FLOAT], source=0, tag=1)
+                    self._unpack_params(start)
+                self._profile_stop('reduce')
+
+        #finish with the same parameters everywhere
+        comm.Bcast([params, MPI.FLOAT], root=0)
+        self._unpack_params(params)
+
+    def force_match_parallel(self, workers = None, batch_size = None, do_plots = False, repeats = 1, frame_number = 0, quiet = False, minibatch = 1):
+        """ Force matching with a pool of local processes instead of
+            MPI. Each worker matches a slice of frames with
+            _force_match_task, then the weights and AdaGrad
+            accumulators of the workers are averaged through shared
+            memory. The trajectory is reopened in each worker, so a
+            CGUniverse must be cached first.
+        """
+
+        if(type(self.u) == CGUniverse):
+            raise ValueError("Cannot fork a CGUniverse. cache() must be called on it to convert to Universe")
+
+        if(workers is None):
+            workers = multiprocessing.cpu_count()
+
+        if(do_plots):
+            self._setup_plot()
+
+        frame_number = frame_number if frame_number > 0 else self.u.trajectory.numframes
+
+        #the tasks of each round, as (first frame, last frame + 1)
+        rounds = []
+        if(batch_size):
+            start = 0
+            while(start < frame_number * repeats):
+                spans = []
+                for i in range(workers):
+                    first = (start + i * batch_size) % frame_number
+                    spans.append( (first, min(frame_number, first + batch_size)) )
+                rounds.append(spans)
+                start += workers * batch_size
+        else:
+            span = frame_number / workers
+            spanr = frame_number - workers * span
+            spans = []
+            for i in range(workers):
+                first = i * span + min(i, spanr)
+                spans.append( (first, first + span + (1 if i < spanr else 0)) )
+            spans = [s for s in spans if s[1] > s[0]]
+            rounds = [spans] * repeats
+
+        #the buffers must exist before the workers fork
+        count = self._param_count()
+        _parallel_state['fm'] = self
+        _parallel_state['params'] = multiprocessing.RawArray('f', count)
+        _parallel_state['results'] = multiprocessing.RawArray('f', count * workers)
+        params = np.ctypeslib.as_array(_parallel_state['params'])
+        results = np.ctypeslib.as_array(_parallel_state['results']).reshape( (workers, count) )
+        self._pack_params(params)
+
+        pool = multiprocessing.Pool(workers, _parallel_init)
+        try:
+            for i,spans in enumerate(rounds):
+                tasks = [(j, s[0], s[1], j == 0 and not quiet, minibatch) for j,s in enumerate(spans)]
+                self._profile_start('workers')
+                pool.map(_parallel_task, tasks)
+                self._profile_stop('workers')
+
+                #average
+                self._profile_start('reduce')
+                params[:] = np.mean(results[:len(tasks)], axis=0)
+                self._unpack_params(params)
+                self._profile_stop('reduce')
+                self.force_match_calls += sum([s[1] - s[0] for s in spans])
+                if(self.profiler):
+                    #the workers' own timings stay in their processes
+                    self.profiler.frames += sum([s[1] - s[0] for s in spans])
+
+                if(not quiet):
+                    print "%d / %d iterations" % (i + 1, len(rounds))
+                    if(do_plots):
+                        self._plot_forces()
+        finally:
+            pool.close()
+            pool.join()
+            _parallel_state.clear()
+
+        print "Complete"
+        if(do_plots):
+            self._teardown_plot()
+
+    def _param_count(self):
+        return 2 * sum([len(f.w) for f in self.tar_forces])
+
+    def _pack_params(self, buffer):
+        """ Packs the weights and AdaGrad accumulators of every target force into buffer
+        """
+        index = 0
+        for f in self.tar_forces:
+            buffer[index:(index + len(f.w))] = f.w[:]
+            index += len(f.w)
+            buffer[index:(index + len(f.w))] = f.lip[:]
+            index += len(f.w)
+        return buffer
+
+    def _unpack_params(self, buffer):
+        index = 0
+        for f in self.tar_forces:
+            f.w[:] = buffer[index:(index + len(f.w))]
+            index += len(f.w)
+            f.lip[:] = buffer[index:(index + len(f.w))]
+            index += len(f.w)
+
+    def _sample_particles(self, ref_forces, minibatch = 1):
+        """ Runs the gradient updates over the particles of the
+            current frame in random order. Gradients are averaged over
+            minibatch particles per update, with 0 meaning the whole
+            frame. Returns the summed relative force error.
+        """
+        N = self.u.atoms.numberOfAtoms()
+        if(not minibatch):
+            minibatch = N
+
+        calls = self._particle_forces(self.tar_forces)
+
+        #track error
+        net_df = 0
+        timer = self.profiler
+        force_time = update_time = 0
+        for k,i in enumerate(random.sample(range(N), N)):
+            if(timer):
+                t0 = time.time()
+            #calculate net forces deviation
+            df = np.array(ref_forces[i], dtype=np.float32)
+            mag_temp = ln.norm(df)
+            for f in calls:
+                df -= f.calc_particle_force(i,self.u)
+            net_df += ln.norm(df) / mag_temp
+            if(timer):
+                t1 = time.time()
+                force_time += t1 - t0
+
+            #now run gradient update step on all the force types
+            if(minibatch == 1):
+                for f in self.tar_forces:
+                    f.update(df)
+            else:
+                for f in self.tar_forces:
+                    f.accumulate_update(df)
+                if((k + 1) % minibatch == 0 or k == N - 1):
+                    for f in self.tar_forces:
+                        f.apply_update()
+            if(timer):
+                update_time += time.time() - t1
+        if(timer):
+            timer.add('target_forces', force_time, N)
+            timer.add('update', update_time, N)
+        return net_df
+
+    def force_match(self, iterations = 0, minibatch = 1, checkpoint = None, checkpoint_every = 100, resume = False):
+        """ Stochastic gradient descent over the frames. minibatch
+            is the number of particles whose gradients are averaged
+            for each update. 0 uses the whole frame. If a checkpoint
+            file is given, the parameters and progress are saved to it
+            every checkpoint_every frames, and with resume the run
+            continues from the frame after the last checkpoint.
+        """
 
         if(iterations == 0):
             iterations = self.u.trajectory.numframes
+
+        frame = 0
+        if(resume):
+            frame = self.load_checkpoint(checkpoint, 'force_match')
         
         ref_forces = np.zeros( (self.u.atoms.numberOfAtoms(), 3) )
-        self.u.trajectory.rewind() # just in case this is called after some analysis has been done
+        if(frame < iterations):
+            self._seek_ts(frame) # just in case this is called after some analysis has been done
         
         #setup plots
         if(self.plot_frequency != -1):
             self._setup_plot()
 
  
-        for ts in self.u.trajectory:
+        while(frame < iterations):
             
             #set box if necessary
             if("box" in self.json):
@@ -217,52 +574,211 @@ class ForceMatch:
 
             self._setup()
 
+            self._profile_start('ref_forces')
             for rf in self.ref_forces:
                 rf.calc_forces(ref_forces, self.u)            
+            self._profile_stop('ref_forces')
 
             #make plots
-            if(self.plot_frequency != -1 and iterations % self.plot_frequency == 0):
+            if(self.plot_frequency != -1 and (iterations - frame) % self.plot_frequency == 0):
+                self._profile_start('plot')
                 self._plot_forces()
+                self._profile_stop('plot')
 
-            #track error
-            net_df = 0
             self.force_match_calls += 1
 
             #sample particles and run updates on them 
-            for i in random.sample(range(self.u.atoms.numberOfAtoms()),self.u.atoms.numberOfAtoms()):
-
-                #calculate net forces deviation
-                df = np.array(ref_forces[i], dtype=np.float32)
-                mag_temp = ln.norm(df)
-                for f in self.tar_forces:
-                    df -= f.calc_particle_force(i,self.u)                    
-                net_df +=  ln.norm(df) / mag_temp
-
-                #now run gradient update step on all the force types
-                for f in self.tar_forces:
-                    f.update(df)
+            net_df = self._sample_particles(ref_forces, minibatch)
 
             ref_forces.fill(0)
             self._teardown()
 
-            print "avg relative magnitude error at %d  = %g" % (iterations, net_df / self.u.atoms.numberOfAtoms())
+            print "avg relative magnitude error at %d  = %g" % (iterations - frame, net_df / self.u.atoms.numberOfAtoms())
+            self._profile_frame()
             
-            iterations -= 1
-            if(iterations == 0):
-                break
+            frame += 1
+            if(checkpoint and (frame % checkpoint_every == 0 or frame == iterations)):
+                self._profile_start('checkpoint')
+                self.save_checkpoint(checkpoint, frame, 'force_match')
+                self._profile_stop('checkpoint')
+            if(frame < iterations):
+                try:
+                    self._next_ts()
+                except (EOFError, IOError):
+                    break
 
         if(not self.plot_output is None):
             self._save_plot()
         if(self.plot_frequency != -1):
             self._teardown_plot()
 
-    def _force_match_task(self, start, end, do_print = False):
+    def save_checkpoint(self, filename, position = 0, mode = 'force_match'):
+        """ Saves the weights and AdaGrad accumulators of the target
+            forces, with the call counter and the position of the run
+            (frame or round) to a numpy npz file.
+        """
+        arrays = {}
+        for i,f in enumerate(self.tar_forces):
+            arrays['w_%d' % i] = f.w
+            arrays['lip_%d' % i] = f.lip
+        arrays['counters'] = np.array([self.force_match_calls, position], dtype=np.int64)
+        arrays['mode'] = np.array(mode)
+        #write then move, so a run killed while saving keeps its last checkpoint
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(temp, filename)
+
+    def load_checkpoint(self, filename, mode = 'force_match'):
+        """ Restores the target forces and call counter from a
+            checkpoint and returns the position to resume from.
+        """
+        data = np.load(filename)
+        if(str(data['mode']) != mode):
+            raise ValueError("Checkpoint %s was written by %s, not %s" % (filename, str(data['mode']), mode))
+        if(len([k for k in data.files if k.startswith('w_')]) != len(self.tar_forces)):
+            raise ValueError("Checkpoint %s does not have the same number of target forces" % filename)
+        for i,f in enumerate(self.tar_forces):
+            if(len(data['w_%d' % i]) != len(f.w)):
+                raise ValueError("Checkpoint %s does not match the parameters of %s" % (filename, f.name))
+            f.w[:] = data['w_%d' % i]
+            f.lip[:] = data['lip_%d' % i]
+        self.force_match_calls = int(data['counters'][0])
+        return int(data['counters'][1])
+
+    def solve_linear(self, iterations = 0, chunk = 256, quiet = False):
+        """ Solves for the weights of the linear target forces (ie
+            SpectralForce) directly with least squares, in one pass
+            over the trajectory. The normal equations are accumulated
+            over every particle and regularizers are added as Tikhonov
+            terms with the same weight they have in force_match. Any
+            other target forces are held fixed. chunk is the number of
+            particles whose gradients are collected before being summed
+            into the normal equations. Only the blocks of the normal
+            equations between forces which act on the same particles,
+            and only the part of each force's weights with support in
+            the chunk, are accumulated.
+        """
+        linear = [f for f in self.tar_forces if f.linear]
+        fixed = [f for f in self.tar_forces if not f.linear]
+        if(len(linear) == 0):
+            raise ValueError("There are no linear target forces to solve for")
+
+        if(iterations == 0):
+            iterations = self.u.trajectory.numframes
+
+        N = self.u.atoms.numberOfAtoms()
+        offsets = np.cumsum([0] + [len(f.w) for f in linear])
+        dim = offsets[-1]
+        GtG = np.zeros( (dim, dim) )
+        Gtf = np.zeros( dim )
+        #rows are the force components of chunk particles
+        G = np.zeros( (3 * chunk, dim) )
+        y = np.zeros( 3 * chunk )
+        #which particles of the chunk each force acts on and the range of weights it touches
+        touched = np.zeros( (chunk, len(linear)), dtype=np.bool_)
+        win_lo = np.array([len(f.w) for f in linear])
+        win_hi = np.zeros(len(linear), dtype=np.int64)
+        samples = 0
+        frames = 0
+
+        linear_calls = self._particle_forces(linear)
+        fixed_calls = self._particle_forces(fixed)
+
+        ref_forces = np.zeros( (N, 3) )
+        self._seek_ts(0)
+
+        while(frames < iterations):
+
+            #set box if necessary
+            if("box" in self.json):
+                #strange ordering due to charm
+                self.u.trajectory.ts._unitcell[0] = self.json["box"][0]
+                self.u.trajectory.ts._unitcell[2] = self.json["box"][1]
+                self.u.trajectory.ts._unitcell[5] = self.json["box"][2]
+
+            self._setup()
+
+            self._profile_start('ref_forces')
+            for rf in self.ref_forces:
+                rf.calc_forces(ref_forces, self.u)
+            self._profile_stop('ref_forces')
+
+            for i in range(N):
+                k = i % chunk
+                y[3 * k:3 * k + 3] = ref_forces[i]
+                for f in fixed_calls:
+                    y[3 * k:3 * k + 3] -= f.calc_particle_force(i, self.u)
+                for f in linear_calls:
+                    f.calc_particle_force(i, self.u)
+                for a,(f,o) in enumerate(zip(linear, offsets)):
+                    #only the compact support window of the gradient is non-zero
+                    if(f.grad_hi > f.grad_lo):
+                        G[3 * k:3 * k + 3, (o + f.grad_lo):(o + f.grad_hi)] = f.temp_grad[f.grad_lo:f.grad_hi].T
+                        touched[k, a] = True
+                        win_lo[a] = min(win_lo[a], f.grad_lo)
+                        win_hi[a] = max(win_hi[a], f.grad_hi)
+                if(k == chunk - 1 or i == N - 1):
+                    self._accumulate_normal(G[:3 * (k + 1)], y[:3 * (k + 1)], touched[:k + 1],
+                                            offsets[:-1] + win_lo, offsets[:-1] + win_hi, GtG, Gtf)
+                    for a,o in enumerate(offsets[:-1]):
+                        G[:, (o + win_lo[a]):(o + win_hi[a])] = 0
+                    touched.fill(False)
+                    win_lo[:] = [len(f.w) for f in linear]
+                    win_hi.fill(0)
+            samples += N
+
+            ref_forces.fill(0)
+            self._teardown()
+
+            self._profile_frame()
+            frames += 1
+            if(not quiet):
+                print "accumulated %d frames" % frames
+            if(frames < iterations):
+                try:
+                    self._next_ts()
+                except (EOFError, IOError):
+                    break
+
+        #regularizer gradients are linear in w, so build their matrices from unit vectors
+        for f,o in zip(linear, offsets):
+            for r in f.regularization:
+                R = np.array([r[0](e) for e in np.identity(len(f.w))]).T
+                GtG[o:(o + len(f.w)), o:(o + len(f.w))] += samples * R
+
+        #solve for the change in w, so weights without any samples stay as they are
+        w = np.concatenate([f.w for f in linear]).astype(np.float64)
+        dw = ln.lstsq(GtG, Gtf - GtG.dot(w), rcond=-1)[0]
+        for f,o in zip(linear, offsets):
+            f.w[:] = w[o:(o + len(f.w))] + dw[o:(o + len(f.w))]
+
+    def _accumulate_normal(self, G, y, touched, lo, hi, GtG, Gtf):
+        """ Adds G^T G and G^T y to GtG and Gtf, block by block. Block
+            a is the columns lo[a] to hi[a] and its rows are the three
+            force components of the particles touched[:,a].
+        """
+        rows = np.repeat(touched, 3, axis=0)
+        blocks = [a for a in range(touched.shape[1]) if touched[:, a].any()]
+        for a in blocks:
+            Ga = G[rows[:, a], lo[a]:hi[a]]
+            Gtf[lo[a]:hi[a]] += Ga.T.dot(y[rows[:, a]])
+            for b in blocks:
+                if(b < a):
+                    continue
+                both = rows[:, a] & rows[:, b]
+                if(not both.any()):
+                    continue
+                block = G[both, lo[a]:hi[a]].T.dot(G[both, lo[b]:hi[b]])
+                GtG[lo[a]:hi[a], lo[b]:hi[b]] += block
+                if(b != a):
+                    GtG[lo[b]:hi[b], lo[a]:hi[a]] += block.T
+
+    def _force_match_task(self, start, end, do_print = False, minibatch = 1):
         ref_forces = np.zeros( (self.u.atoms.numberOfAtoms(), 3) )
 
         
-        self.u.trajectory.rewind()
-        for i in range(start):
-            self.u.trajectory.next()
+        self._seek_ts(start)
         
         for tsi in range(start,end):
             ts = self.u.trajectory.ts
@@ -276,99 +792,144 @@ class ForceMatch:
 
             self._setup()
 
+            self._profile_start('ref_forces')
             for rf in self.ref_forces:
                 rf.calc_forces(ref_forces, self.u)            
+            self._profile_stop('ref_forces')
 
-            #track error
-            net_df = 0            
             self.force_match_calls += 1
 
             #sample particles and run updates on them 
-            for i in random.sample(range(self.u.atoms.numberOfAtoms()),self.u.atoms.numberOfAtoms()):
-                #calculate net forces deviation
-                df = np.array(ref_forces[i], dtype=np.float32)
-                mag_temp = ln.norm(df)
-                for f in self.tar_forces:
-                    df -= f.calc_particle_force(i,self.u)
-                net_df += ln.norm(df) / mag_temp
-
-                #now run gradient update step on all the force types
-                for f in self.tar_forces:
-                    f.update(df)
+            net_df = self._sample_particles(ref_forces, minibatch)
 
             ref_forces.fill(0)
             self._teardown()
 
             if(do_print):
                 print "avg relative magnitude error  = %g" % (net_df / self.u.atoms.numberOfAtoms())
+            self._profile_frame()
                 
 
             if(tsi != end - 1):
-                self.u.trajectory.next()
-
-
-
-    def _pack_tar_forces(self):
-        if(self.send_buffer is None):
-            count = 0
-            for f in self.tar_forces:
-                count += len(f.w)
-            self.send_buffer = np.empty((count,), dtype=np.float32)
-            
-        index = 0
-        for f in self.tar_forces:
-            self.send_buffer[index:(index + len(f.w))] = f.w[:]
-            index += len(f.w)
-        
-        return self.send_buffer
+                self._next_ts()
 
-    def _unpack_tar_forces(self):
-        index = 0
-        for f in self.tar_forces:
-            f.w[:] = self.rec_buffer[index:(index + len(f.w))]
-            index += len(f.w)
 
-    def _reduce_tasks(self):
 
-        self._pack_tar_forces()
-        
+    def _reduce_tasks(self, overlap = False, weight = 1):
+        """ Averages the weights and AdaGrad accumulators of the target
+            forces over all ranks with a single Allreduce. Each rank
+            counts by weight, ie the number of frames it matched. With
+            overlap, the reduction is only started here. It is finished
+            at the next call, after the next batch, and the local
+            changes from that batch are added to the average.
+        """
         comm = MPI.COMM_WORLD
-        rank = comm.Get_rank()
-
-        #sum all of em
-        if(self.rec_buffer is None):
-            self.rec_buffer = np.copy(self.send_buffer)
 
-        comm.Reduce([self.send_buffer, MPI.FLOAT], [self.rec_buffer, MPI.FLOAT])
-        
-        #average
-        if rank == 0:
-            self.rec_buffer /= comm.Get_size()
-            
-        self.rec_buffer = comm.bcast(self.rec_buffer) #broadcast the average
-        
-        self._unpack_tar_forces()
-
-    def _distribute_tasks(self, batch_size = None, offset = 0, quiet=False, frame_number = 0):
+        if(self.send_buffer is None):
+            #the last element carries the weight of each rank
+            self.send_buffer = np.empty( (self._param_count() + 1,), dtype=np.float32)
+            self.rec_buffer = np.empty_like(self.send_buffer)
+
+        self._finish_reduce()
+        self._profile_start('reduce')
+        self._pack_params(self.send_buffer)
+        if(overlap and hasattr(comm, 'Iallreduce')):
+            self.reduce_start = np.copy(self.send_buffer)
+        self.send_buffer[:-1] *= weight
+        self.send_buffer[-1] = weight
+
+        if(overlap and hasattr(comm, 'Iallreduce')):
+            self.reduce_request = comm.Iallreduce([self.send_buffer, MPI.FLOAT], [self.rec_buffer, MPI.FLOAT], op=MPI.SUM)
+        else:
+            comm.Allreduce([self.send_buffer, MPI.FLOAT], [self.rec_buffer, MPI.FLOAT], op=MPI.SUM)
+            if(self.rec_buffer[-1] > 0):
+                self.rec_buffer[:-1] /= self.rec_buffer[-1]
+                self._unpack_params(self.rec_buffer)
+        self._profile_stop('reduce')
+
+    def _finish_reduce(self):
+        if(self.reduce_request is None):
+            return
+        self._profile_start('reduce')
+        self.reduce_request.Wait()
+        self.reduce_request = None
+        if(self.rec_buffer[-1] > 0):
+            self.rec_buffer[:-1] /= self.rec_buffer[-1]
+            #add the changes made locally while the reduction was in flight
+            self.rec_buffer[:-1] += self._pack_params(np.empty_like(self.rec_buffer))[:-1] - self.reduce_start[:-1]
+            self._unpack_params(self.rec_buffer)
+        self._profile_stop('reduce')
+
+    def _work_counter(self, rounds):
+        """ Counters on rank 0, one per round, which every rank
+            increments to claim the next chunk of frames in that
+            round. Since no counter is reused, ranks can move on to the
+            next round without waiting for each other. False if MPI has
+            no atomic one-sided operations, in which case chunks are
+            dealt out round robin. Collective, so every rank must call it.
+        """
+        comm = MPI.COMM_WORLD
+        if(self.work_window):
+            self.work_window.Free()
+        if(hasattr(MPI, 'Win') and hasattr(MPI.Win, 'Fetch_and_op')):
+            self.work_memory = np.zeros( (rounds if comm.Get_rank() == 0 else 0,), dtype=np.int64)
+            self.work_window = MPI.Win.Create(self.work_memory, disp_unit=self.work_memory.itemsize, comm=comm)
+        else:
+            self.work_window = False
+        return self.work_window
+
+    def _claim_chunk(self, round):
+        one = np.ones( (1,), dtype=np.int64)
+        claimed = np.empty( (1,), dtype=np.int64)
+        self.work_window.Lock(0)
+        self.work_window.Fetch_and_op([one, MPI.INT64_T], [claimed, MPI.INT64_T], 0, round, MPI.SUM)
+        self.work_window.Unlock(0)
+        return claimed[0]
+
+    def _distribute_tasks(self, chunks, round, quiet=False, minibatch = 1):
+        """ Matches one round of frame chunks, given as (first frame,
+            last frame + 1). The chunks are a work queue which the ranks
+            pull from, so faster ranks match more of them and each chunk
+            is matched once. Returns the number of frames matched by
+            this rank.
+        """
         comm = MPI.COMM_WORLD
         size = comm.Get_size()
         rank = comm.Get_rank()
 
-        frame_number = frame_number if frame_number > 0 else self.u.trajectory.numframes
-        span = frame_number / size
-        
-        #get remainder
-        spanr = frame_number - size * span
-
-        if(batch_size):
-            #use batch size
-            self._force_match_task(spanr / 2 + rank * span + offset, spanr / 2 + rank * span + batch_size + offset, rank == 0 and not quiet)
+        frames = 0
+        counter = self.work_window
+        if(counter):
+            claim = self._claim_chunk(round)
         else:
-            #distribute equally on the trajectory
-            if(rank < spanr):
-                self._force_match_task(rank * (span + 1), (rank + 1) * (span + 1), rank == 0 and not quiet)
+            claim = rank
+        while(claim < len(chunks)):
+            assert 0 <= claim, 'Claimed chunk %d of a round' % claim
+            try:
+                self._force_match_task(chunks[claim][0], chunks[claim][1], rank == 0 and not quiet, minibatch)
+            except (EOFError, IOError):
+                #just finished reading the file, eat the exception. Will be rewound in force_match_task
+                pass
+            frames += chunks[claim][1] - chunks[claim][0]
+            if(counter):
+                claim = self._claim_chunk(round)
             else:
-                self._force_match_task(rank * span + spanr, (rank + 1) * span + spanr, rank == 0 and not quiet)
+                claim += size
+        return frames
+
+    def _report_throughput(self, frames, seconds, quiet=False):
+        """ Records each rank's throughput in frames per second on
+            rank 0. Collective, so it is only called where the ranks
+            synchronize anyway.
+        """
+        comm = MPI.COMM_WORLD
+        stats = np.array([frames, seconds], dtype=np.float64)
+        all_stats = np.empty( (comm.Get_size(), 2), dtype=np.float64)
+        comm.Gather([stats, MPI.DOUBLE], [all_stats, MPI.DOUBLE], root=0)
+        if(comm.Get_rank() == 0):
+            self.rank_throughput = all_stats[:,0] / np.maximum(all_stats[:,1], 1e-9)
+            if(not quiet):
+                print "frames per second by rank: %s" % " ".join(["%.3g" % x for x in self.rank_throughput])
         
     def observation_match(self, target_obs = None, obs_sweeps = 25, obs_samples = None, reject_tol = None, do_plots = True):
         """ Match observations.
@@ -434,7 +995,6 @@ class ForceMatch:
             #now we esimtate gradient of the loss function via importance sampling
             normalization = 0
                 
-            #note, this reading method is so slow. I should implement the frame jump in xyz
             rejects = 0
             i = 0
 
@@ -557,33 +1117,108 @@ class ForceMatch:
 
 
     def add_and_type_pair(self, force):
-        types = []
-        for a in self.u.atoms:
-            if(not a.type in types):
-                types.append(a.type)
+        types = atom_type_ids(self.u)[0]
+        clones = []
         for i in range(len(types)):
             for j in range(i,len(types)):
                 if(force.category.pair_exists(self.u, 'type %s' % types[i], 'type %s' % types[j])):
                     f = force.clone_force()
                     f.specialize_types(types[i], types[j])
                     self.add_tar_force(f)
+                    clones.append(f)
+        #let the clones share one pass over the neighbor list, if the force supports it
+        if(len(clones) > 1):
+            group = force.group_clones(clones)
+            if(group is not None):
+                for f in clones:
+                    f.force_group = group
+
+    def _particle_forces(self, forces):
+        """ The forces to call calc_particle_force on, with forces in
+            a group replaced by the group
+        """
+        calls = []
+        for f in forces:
+            if(f.force_group is None):
+                calls.append(f)
+            elif(not f.force_group in calls):
+                calls.append(f.force_group)
+        return calls
 
     def _sample_ts(self):
-        self.u.trajectory.rewind()
         index = random.randint(0,self.u.trajectory.numframes - 1)
-        [self.u.trajectory.next() for x in range(index)]
+        self._seek_ts(index)
         return index
+
+    def _frame_index(self):
+        """ The frame offset index of an xyz trajectory, or None for
+            other formats
+        """
+        traj = self.u.trajectory
+        if(getattr(traj, 'format', None) != 'XYZ'):
+            return None
+        if(self.frame_index is None or self.frame_index.filename != traj.filename):
+            self.frame_index = XYZIndex(traj.filename)
+        return self.frame_index
+
+    def _seek_ts(self, index):
+        """ Moves the trajectory to the given frame, counting from 0.
+            Uses random access if the reader has it or the frame offset
+            index for xyz files, otherwise reads forward from the
+            start. Seeking past the last frame raises IOError, as
+            reading past the end of the file does.
+        """
+        self._profile_start('trajectory')
+        self.indexed_frame = None
+        try:
+            try:
+                self.u.trajectory[index]
+                return
+            except (TypeError, NotImplementedError, AttributeError):
+                pass
+            except IndexError:
+                raise IOError("Frame %d is past the end of the trajectory" % index)
+            frame_index = self._frame_index()
+            if(frame_index is not None):
+                #the reader is left where it was, so _next_ts reads on from the index
+                frame_index.read_frame(index, self.u.trajectory.ts)
+                self.indexed_frame = index
+                return
+            self.u.trajectory.rewind()
+            for x in range(index):
+                self.u.trajectory.next()
+        finally:
+            self._profile_stop('trajectory')
+
+    def _next_ts(self):
+        self._profile_start('trajectory')
+        try:
+            if(self.indexed_frame is None):
+                self.u.trajectory.next()
+            else:
+                self.frame_index.read_frame(self.indexed_frame + 1, self.u.trajectory.ts)
+                self.indexed_frame += 1
+        finally:
+            self._profile_stop('trajectory')
                    
 
         
             
     def _setup(self):        
+        #mostly building neighbor lists
+        self._profile_start('neighbor_list')
         for rfcat in self.ref_cats:
             rfcat._setup(self.u)
         for tfcat in self.tar_cats:
             tfcat._setup(self.u)        
+        self._profile_stop('neighbor_list')
 
     def _teardown(self):
+        if(self.profiler):
+            #pairs evaluated by the target forces this frame, counted before the categories drop them.
+            #a category appears once per force using it
+            cats = dict((id(c), c) for c in self.tar_cats).values()
+            self.frame_pairs = sum([len(c.pairs[0]) for c in cats if getattr(c, 'pairs', None) is not None])
         for rfcat in self.ref_cats:
             rfcat._teardown()
         for tfcat in self.tar_cats:
@@ -688,12 +1323,7 @@ class ForceMatch:
         """Return the atom type index for the given type string. Index starts from 1.
         """
         if(self.atom_type_map is None):
-            self.atom_type_map = {}
-            index = 1
-            for a in self.u.atoms:
-                if(not a.type in self.atom_type_map):
-                    self.atom_type_map[a.type] = index
-                    index += 1
+            self.atom_type_map = dict([(t, k + 1) for k,t in enumerate(atom_type_ids(self.u)[0])])
         if(type(atom_type) != type("")):
             assert(type(atom_type) == type(self.u.atoms[0]))
             atom_type = atom_type.type
@@ -1,6 +1,7 @@
 from ForcePy.ForceCategories import Pairwise, Bond, Angle, Dihedral
 from ForcePy.Mesh import UniformMesh 
-from ForcePy.Util import norm3, spec_force_inner_loop, min_img_vec
+from ForcePy.Util import spec_force_inner_loop
+from ForcePy.LammpsDump import LammpsDump
 
 import numpy as np
 import random
@@ -8,11 +9,23 @@ import numpy.linalg as ln
 from MDAnalysis import Universe
 from math import ceil,log
 
+def _scatter_add(forces, index, vectors):
+    """forces[index[k]] += vectors[k], accumulating repeated indices
+    """
+    for c in range(3):
+        forces[:,c] += np.bincount(index, weights=vectors[:,c], minlength=len(forces))
+
 class Force(object):
     """Can calculate forces from a universe object.
 
        To be used in the stochastic gradient step, a force should implement all of the methods here
     """
+
+    #forces which are linear in w, with temp_grad holding d force / d w, may be solved directly
+    linear = False
+
+    #set on forces evaluated together by a group, see group_clones
+    force_group = None
     
     def _setup_update_params(self, w_dim, initial_w=-500, eta=None, hard_pow=12):
         """ Assumes a line from given initial height down to zero. Basically repulsive force
@@ -33,23 +46,64 @@ class Force(object):
         self.temp_grad = np.empty( (w_dim, 3) , dtype=np.float32)
         self.temp_force = np.empty( 3 , dtype=np.float32)
         self.w_grad = np.empty( w_dim, dtype=np.float32)
+        #the rows of temp_grad which may be non-zero. Forces with a compact basis narrow this
+        self.grad_lo = 0
+        self.grad_hi = w_dim
+        #accumulated gradient for mini-batch updates
+        self.batch_grad = np.zeros( w_dim, dtype=np.float32)
+        self.batch_count = 0
+        self.batch_lo = w_dim
+        self.batch_hi = 0
         self.regularization = []
         self.lip = np.ones( np.shape(self.w) , dtype=np.float32)
         self.sel1 = None
         self.sel2 = None
 
     def update(self, df):
-        negative_grad = self.w_grad #not actually negative yet. The negative sign is in the df
-        np.dot(self.temp_grad, df, negative_grad)
-        
+        #only the window of temp_grad which may be non-zero contributes
+        lo, hi = self.grad_lo, self.grad_hi
+        if(len(self.regularization) > 0):
+            lo, hi = 0, len(self.w)
+        negative_grad = self.w_grad[lo:hi] #not actually negative yet. The negative sign is in the df
+        np.dot(self.temp_grad[lo:hi], df, negative_grad)
+        self._adagrad_step(negative_grad, lo, hi)
+
+    def accumulate_update(self, df):
+        """ Adds the gradient of the last calc_particle_force call to
+            the mini-batch without changing w. Call apply_update to take the step.
+        """
+        lo, hi = self.grad_lo, self.grad_hi
+        self.batch_grad[lo:hi] += np.dot(self.temp_grad[lo:hi], df)
+        self.batch_lo = min(self.batch_lo, lo)
+        self.batch_hi = max(self.batch_hi, hi)
+        self.batch_count += 1
+
+    def apply_update(self):
+        """ Takes one step with the mean gradient of the accumulated mini-batch
+        """
+        if(self.batch_count == 0):
+            return
+        lo, hi = min(self.batch_lo, self.batch_hi), self.batch_hi
+        if(len(self.regularization) > 0):
+            lo, hi = 0, len(self.w)
+        negative_grad = self.batch_grad[lo:hi]
+        negative_grad /= self.batch_count
+        self._adagrad_step(negative_grad, lo, hi)
+
+        negative_grad.fill(0)
+        self.batch_count = 0
+        self.batch_lo = len(self.w)
+        self.batch_hi = 0
+
+    def _adagrad_step(self, negative_grad, lo, hi):
         #apply any regularization
         for r in self.regularization:
             negative_grad -= r[0](self.w)
-        self.lip +=  np.square(negative_grad)
+        self.lip[lo:hi] +=  np.square(negative_grad)
 
         #we should be taking the negative of the dot product
         #but its easier to put the minus sign in this expression
-        self.w = self.w + self.eta / np.sqrt(self.lip) * negative_grad
+        self.w[lo:hi] += self.eta / np.sqrt(self.lip[lo:hi]) * negative_grad
 
 
     #In case the force needs access to the universe for setting up, override (and call this method).
@@ -79,19 +133,20 @@ class Force(object):
 
 
     def _build_mask(self, sel1, sel2, u):
+        #masks come from the type ids cached by the category, instead of a selection per force
+        if(sel1 is None and sel2 is None):
+            #no type specialization, so the pairs are used unmasked
+            self.mask1 = self.mask2 = None
+            return
         if(sel1 is None):
-            self.mask1 = [True for x in range(u.atoms.numberOfAtoms())]
+            self.mask1 = np.ones(u.atoms.numberOfAtoms(), dtype=np.bool_)
         else:
-            self.mask1 = [False for x in range(u.atoms.numberOfAtoms())]
-            for a in u.selectAtoms('type %s' % sel1):
-                self.mask1[a.number] = True
+            self.mask1 = self.category.type_mask(u, sel1)
             
         if(sel2 is None):
             self.mask2 = self.mask1
         else:
-            self.mask2 = [False for x in range(u.atoms.numberOfAtoms())]
-            for a in u.selectAtoms('type %s' % sel2):
-                self.mask2[a.number] = True
+            self.mask2 = self.category.type_mask(u, sel2)
 
     def valid_pair(self, atom1, atom2):
         """Checks the two atoms' types to see if they match the type
@@ -268,6 +323,14 @@ class Force(object):
         """
         raise NotImplementedError("Must implement this function")        
 
+    def group_clones(self, clones):
+        """Returns an object whose calc_particle_force evaluates all of
+           the type specialized clones of this force at once, or None
+           if they must be evaluated one at a time. The caller registers
+           the group by setting force_group on each clone.
+        """
+        return None
+
 class FileForce(Force):
     """ Reads forces from the trajectory file
     """
@@ -282,21 +345,14 @@ class FileForce(Force):
 class LammpsFileForce(Force):
     """Reads forces from a lammps force output
     """
-    def LammpsFileForce(self, file_name):
-        self.file = open(file_name, 'r')
+    def __init__(self, file_name):
+        self.dump = LammpsDump(file_name)
 
     def calc_forces(self, forces, u):
-        while(not self.file.readline().startswith('ITEM: ATOMS')):
-            pass
-        for i in range(len(forces)):
-            sline = self.file.readline().split()
-            try:
-                forces[int(sline[0]),:] = [-float(x) for x in sline[1:]]
-            except ValueError:
-                print "Invalid forces line at %s" % reduce(lambda x,y: x + y, sline)
+        self.dump.read_forces(forces)
             
     def clone_force(self):
-          return LammpsFileForce(self.file.name)
+          return LammpsFileForce(self.dump.filename)
 
 class AnalyticForce(Force):
     """ A pairwise analtric force that takes in a function for
@@ -306,14 +362,20 @@ class AnalyticForce(Force):
     gradient should take in the pairwise distance and a vector of
     length n (as set in the constructor).  It should return a gradient
     of length n.
+
+    If vectorized is set, the functions are instead passed an array
+    of distances and return an array with the force (or potential) of
+    each, and the gradient as an n x len(d) array. Every pair is then
+    evaluated in one call.
     
     """
 
 
-    def __init__(self, category, f, g, n, cutoff=None, potential = None):
+    def __init__(self, category, f, g, n, cutoff=None, potential = None, vectorized = False):
         self.call_force = f
         self.call_grad = g
         self.call_potential = potential
+        self.vectorized = vectorized
         self.w = np.zeros( n )
         self._setup_update_params(n)        
         self.category = category.get_instance(cutoff)
@@ -322,8 +384,8 @@ class AnalyticForce(Force):
         self._short_name = "AF_%s" % category.__name__
 
     def clone_force(self):
-        assert type(copy) == AnalyticForce, "Must implement clone_force method for %s" % type(copy)
-        copy = AnalyticForce(self.category.__class__, self.call_force, self.call_grad, len(self.w), self.cutoff, self.call_potential)
+        assert type(self) == AnalyticForce, "Must implement clone_force method for %s" % type(self)
+        copy = AnalyticForce(self.category.__class__, self.call_force, self.call_grad, len(self.w), self.cutoff, self.call_potential, self.vectorized)
         return copy
 
     @property
@@ -339,12 +401,18 @@ class AnalyticForce(Force):
 
 
     def calc_force_array(self, d, forces):
+        if(self.vectorized):
+            forces[:] = self.call_force(np.asarray(d), self.w)
+            return
         for i in range(len(d)):
             forces[i] = self.call_force(d[i], self.w)
 
     def calc_potential_array(self, d, potentials):
         if(self.call_potential is None):
             return
+        if(self.vectorized):
+            potentials[:] = self.call_potential(np.asarray(d), self.w)
+            return
         for i in range(len(d)):
             potentials[i] = self.call_potential(d[i], self.w)
 
@@ -352,61 +420,43 @@ class AnalyticForce(Force):
         if(self.call_potential is None):
             return 0
 
-        positions = u.atoms.get_positions()
-        nlist_accum = 0
         potential = 0
-        dims = u.trajectory.ts.dimensions
-        for i in range(u.atoms.numberOfAtoms()):
-            #check atom types
-            if(self.mask1[i]):
-                maskj = self.mask2
-            elif(self.mask2[i]):
-                maskj = self.mask1
-            else:
-                continue
-            for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-                #do not double count
-                if(i < j):
-                    continue
-                potential += self.call_potential(d,self.w)
-            nlist_accum += self.category.nlist_lengths[i]
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2)
+        #do not double count
+        if(self.vectorized):
+            return np.sum(self.call_potential(d[ii >= jj], self.w))
+        for k in np.nonzero(ii >= jj)[0]:
+            potential += self.call_potential(d[k],self.w)
         return potential
                                      
 
     def calc_forces(self, forces, u):
         
-        positions = u.atoms.get_positions()
-        nlist_accum = 0
-        dims = u.trajectory.ts.dimensions
-        for i in range(u.atoms.numberOfAtoms()):
-            #check atom types
-            if(self.mask1[i]):
-                maskj = self.mask2
-            elif(self.mask2[i]):
-                maskj = self.mask1
-            else:
-                continue
-            for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-                forces[i] += self.call_force(d,self.w) * (r / d)
-            nlist_accum += self.category.nlist_lengths[i]
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2)
+        if(self.vectorized):
+            f = self.call_force(d, self.w)
+        else:
+            f = np.empty( len(d) )
+            for k in range(len(d)):
+                f[k] = self.call_force(d[k],self.w)
+        _scatter_add(forces, ii, (f / d)[:,np.newaxis] * r)
 
 
     def calc_particle_force(self, i, u):
 
-        self.temp_force.fill(0)
-        self.temp_grad.fill(0)
-
-        if(self.mask1[i]):
-            maskj = self.mask2
-        elif(self.mask2[i]):
-            maskj = self.mask1
-        else:
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2, i)
+        if(self.vectorized):
+            #sum over the pairs as matrix products
+            self.temp_force[:] = np.dot(self.call_force(d, self.w), r)
+            self.temp_grad[:] = np.dot(np.reshape(self.call_grad(d, self.w), (len(self.w), len(d))), r)
             return self.temp_force
 
-        for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-            self.temp_force += self.call_force(d, self.w) * r
-            f_grad = self.call_grad(d, self.w)            
-            self.temp_grad +=  np.outer(f_grad, r)
+        self.temp_force.fill(0)
+        self.temp_grad.fill(0)
+        for k in range(len(d)):
+            self.temp_force += self.call_force(d[k], self.w) * r[k]
+            f_grad = self.call_grad(d[k], self.w)            
+            self.temp_grad +=  np.outer(f_grad, r[k])
         return self.temp_force
     
 
@@ -414,7 +464,7 @@ class LJForce(AnalyticForce):
     """ Lennard jones pairwise analytic force. Not shifted (!)
     """
     def __init__(self, cutoff, sigma=1, epsilon=1):
-        super(LJForce, self).__init__(Pairwise, LJForce.lj, LJForce.dlj, 2, cutoff, LJForce.ulj)
+        super(LJForce, self).__init__(Pairwise, LJForce.lj, LJForce.dlj, 2, cutoff, LJForce.ulj, vectorized=True)
         self.w[0] = epsilon
         self.w[1] = sigma
         self._long_name = "LJForce"
@@ -442,7 +492,7 @@ class LJForce(AnalyticForce):
 
 class HarmonicForce(AnalyticForce):
     def __init__(self, category, cutoff=None):
-        super(HarmonicForce, self).__init__(category, HarmonicForce.force, HarmonicForce.grad, 2, cutoff, HarmonicForce.potential)
+        super(HarmonicForce, self).__init__(category, HarmonicForce.force, HarmonicForce.grad, 2, cutoff, HarmonicForce.potential, vectorized=True)
         self._setup_update_params(2, [1., self.maxd / 2.], eta=0.1)
 
     def clone_force(self):
@@ -457,7 +507,7 @@ class HarmonicForce(AnalyticForce):
     
     @staticmethod
     def grad(d, w):
-        return [2 * (d - w[1]), -2 * w[0]]
+        return [2 * (d - w[1]), -2 * w[0] * np.ones_like(d)]
 
     @staticmethod
     def potential(d,w):
@@ -471,7 +521,7 @@ class FixedHarmonicForce(AnalyticForce):
        forces
     """
     def __init__(self, category, k, x0=None, x0_guess=None):
-        super(FixedHarmonicForce, self).__init__(category, HarmonicForce.force, self.grad, 2, None, HarmonicForce.potential)
+        super(FixedHarmonicForce, self).__init__(category, HarmonicForce.force, self.grad, 2, None, HarmonicForce.potential, vectorized=True)
         self.w_grad.fill(0) #we might not update and want it correct
         self.k = k
         self.x0 = x0
@@ -488,21 +538,14 @@ class FixedHarmonicForce(AnalyticForce):
 
     def calc_particle_force(self, i, u):
         self.temp_force.fill(0)
-        if(self.mask1[i]):
-            maskj = self.mask2
-        elif(self.mask2[i]):
-            maskj = self.mask1
-        else:
-            return self.temp_force
-        
-        for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-            self.w_grad[1] += -(d - self.w[1])
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2, i)
+        self.w_grad[1] += -np.sum(d - self.w[1])
 
         return self.temp_force
 
         
     def grad(self, d, w):
-        return [0,0]
+        return np.zeros( (2, np.size(d)) )
 
     def update(self, df):
         #slightly modified
@@ -510,6 +553,17 @@ class FixedHarmonicForce(AnalyticForce):
         self.w = self.w - self.eta / np.sqrt(self.lip) * self.w_grad
         self.w_grad.fill(0)
 
+    def accumulate_update(self, df):
+        #the gradient is already summed into w_grad by calc_particle_force
+        self.batch_count += 1
+
+    def apply_update(self):
+        if(self.batch_count == 0):
+            return
+        self.w_grad /= self.batch_count
+        self.update(None)
+        self.batch_count = 0
+
 
     @property
     def mind(self):
@@ -574,6 +628,8 @@ class SpectralForce(Force):
     passed after the two arguments. For example, the function may be
     defined as so: def unit_step(x, mesh, height).
     """
+
+    linear = True
     
     def __init__(self, category, mesh, basis):
         self.basis = basis
@@ -602,49 +658,35 @@ class SpectralForce(Force):
         copy = SpectralForce(self.category.__class__, self.mesh, self.basis)
         return copy           
 
+    def group_clones(self, clones):
+        return SpectralForceGroup(clones)
+
     def calc_force_array(self, d, forces):
-        for i in range(len(d)):
-            forces[i] = self.w.dot(self.basis.force(d[i], self.mesh))        
+        forces[:] = self.basis.force_dot(d, self.w, self.mesh)
 
     def calc_potential_array(self, d, potentials):
-        for i in range(len(d)):
-            potentials[i] = self.w.dot(self.basis.potential(d[i], self.mesh))        
+        potentials[:] = self.basis.potential_dot(d, self.w, self.mesh)
 
 
     def calc_potentials(self, u):
 
-        potential = 0
         self.temp_grad.fill(0)
-        for i in range(u.atoms.numberOfAtoms()):
-            #check to if this is a valid type
-            if(self.mask1[i]):
-                maskj = self.mask2
-            elif(self.mask2[i]):
-                maskj = self.mask1
-            else:
-                continue
-            for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-                if( i < j):
-                    continue
-                temp = self.basis.potential(d, self.mesh)
-                potential += self.w.dot(temp)
-                self.temp_grad[:,1] += temp
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2)
+        #do not double count
+        keep = ii >= jj
+        grad = np.zeros( len(self.w), dtype=np.float32)
+        potential = np.sum(self.basis.potential_dot(d[keep], self.w, self.mesh, grad), dtype=np.float64)
+        self.temp_grad[:,1] = grad
+        self.grad_lo, self.grad_hi = 0, len(self.w)
 
         return potential
 
     
     def calc_forces(self, forces, u):        
-        for i in range(u.atoms.numberOfAtoms()):
-            #check to if this is a valid type
-            if(self.mask1[i]):
-                maskj = self.mask2
-            elif(self.mask2[i]):
-                maskj = self.mask1
-            else:
-                continue
-            for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-                force = self.w.dot(self.basis.force(d, self.mesh)) * (r / d)
-                forces[i] += force
+        #evaluate every pair of the frame at once and scatter the forces to the particles
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2)
+        f = self.basis.force_dot(d, self.w, self.mesh)
+        _scatter_add(forces, ii, (f / d)[:,np.newaxis] * r)
 
     def calc_particle_force(self, i, u):
         """
@@ -654,16 +696,8 @@ class SpectralForce(Force):
         """
 
         self.temp_force.fill(0)
-        self.temp_grad.fill(0)
-
-
-        #check type
-        if(self.mask1[i]):
-            maskj = self.mask2
-        elif(self.mask2[i]):
-            maskj = self.mask1
-        else:
-            return self.temp_force
+        #only the rows touched by the last particle need to be cleared
+        self.temp_grad[self.grad_lo:self.grad_hi].fill(0)
 
 #needed for weaving code:
 #        w_length = len(self.w)
@@ -671,12 +705,17 @@ class SpectralForce(Force):
 #        temp_grad = self.temp_grad
 #        force = self.temp_force
 
-        temp = np.empty( len(self.w) , dtype=np.float32)
-        dims = u.trajectory.ts.dimensions
-        for r,d,j in self.category.generate_neighbor_vecs(i, u, maskj):
-            self.basis.force_cache(d, temp, self.mesh)
+        #the category restricts the pairs to the type masks
+        ii, jj, r, d = self.category.neighbor_vecs(u, self.mask1, self.mask2, i)
+        lo, hi = len(self.w), 0
+        for k in range(len(d)):
+            #only the basis functions with support at d[k] are evaluated
+            start, temp = self.basis.force_sparse(d[k], self.mesh)
             #tuned cython funciton
-            spec_force_inner_loop(self.w, temp, self.temp_grad, self.temp_force, r)
+            spec_force_inner_loop(self.w, temp, self.temp_grad, self.temp_force, r[k], start)
+            lo = min(lo, start)
+            hi = max(hi, start + len(temp))
+        self.grad_lo, self.grad_hi = min(lo, hi), hi
 # weave code:
 #            code = """
 #                   #line 255 "Forces.py"
@@ -698,3 +737,49 @@ class SpectralForce(Force):
         return self.temp_force
 
 
+
+class SpectralForceGroup(object):
+    """Evaluates SpectralForces which are specialized to different
+    type pairs with a single pass over the neighbors of each
+    particle. Each pair is sent to the force for its types using the
+    type table of the category, so the cost doesn't grow with the
+    number of type pairs. The forces keep their own weights, gradients
+    and updates as if they had been evaluated separately.
+    """
+
+    def __init__(self, forces):
+        self.forces = list(forces)
+        self.category = self.forces[0].category
+        self.temp_force = np.zeros( 3 )
+        self.table = None
+        self.table_key = None
+
+    def calc_particle_force(self, i, u):
+        ids = self.category._load_types(u)
+        if(self.table_key != id(u)):
+            self.table = self.category.type_table(u, self.forces)
+            self.table_key = id(u)
+
+        for f in self.forces:
+            f.temp_force.fill(0)
+            f.temp_grad[f.grad_lo:f.grad_hi].fill(0)
+        lo = [len(f.w) for f in self.forces]
+        hi = [0] * len(self.forces)
+
+        ii, jj, r, d = self.category.neighbor_vecs(u, i=i)
+        index = self.table[ids[i], ids[jj]]
+        for k in range(len(d)):
+            n = index[k]
+            if(n < 0):
+                continue
+            f = self.forces[n]
+            start, temp = f.basis.force_sparse(d[k], f.mesh)
+            spec_force_inner_loop(f.w, temp, f.temp_grad, f.temp_force, r[k], start)
+            lo[n] = min(lo[n], start)
+            hi[n] = max(hi[n], start + len(temp))
+
+        self.temp_force.fill(0)
+        for f,l,h in zip(self.forces, lo, hi):
+            f.grad_lo, f.grad_hi = min(l, h), h
+            self.temp_force += f.temp_force
+        return self.temp_force
@@ -0,0 +1,139 @@
+import os, gzip, bz2
+import numpy as np
+
+
+def open_text(filename):
+    '''Opens a text trajectory for binary reading, decompressing it if
+       it's gzipped or bzipped
+    '''
+    if(filename.endswith('.gz')):
+        return gzip.open(filename, 'rb')
+    if(filename.endswith('.bz2')):
+        return bz2.BZ2File(filename, 'rb')
+    return open(filename, 'rb')
+
+def _file_stamp(filename):
+    #the size and modification time in ns, which identify a version of the file
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime * 1e9)]
+
+def _load_index(filename):
+    index_file = filename + '.offsets.npy'
+    if(os.path.exists(index_file)):
+        offsets = np.load(index_file)
+        #the last two entries stamp the file the index was built from
+        if(len(offsets) > 1 and list(offsets[-2:]) == _file_stamp(filename)):
+            return offsets[:-2]
+    return None
+
+def _save_index(filename, offsets, save):
+    offsets = np.array(list(offsets) + _file_stamp(filename), dtype=np.int64)
+    if(save):
+        try:
+            np.save(filename + '.offsets.npy', offsets)
+        except IOError:
+            pass #can't write next to the trajectory, just don't persist
+    return offsets[:-2]
+
+def frame_offsets(filename, marker='ITEM: TIMESTEP', save=True):
+    '''Returns the byte offset at which each frame of a text
+       trajectory begins, where a frame starts with a line beginning
+       with marker. The index is saved next to the trajectory as
+       filename.offsets.npy and reused while the file size and
+       modification time are unchanged. Offsets of compressed files are into the decompressed text.
+    '''
+    offsets = _load_index(filename)
+    if(offsets is not None):
+        return offsets
+
+    key = '\n' + marker
+    offsets = []
+    f = open_text(filename)
+    try:
+        position = 0
+        #a leading newline finds a marker on the first line
+        carry = '\n'
+        while(True):
+            block = f.read(2 ** 24)
+            if(not block):
+                break
+            text = carry + block
+            start = position - len(carry)
+            i = text.find(key)
+            while(i != -1):
+                offsets.append(start + i + 1)
+                i = text.find(key, i + 1)
+            #keep enough to find a marker split between blocks, but never a whole one
+            carry = text[-(len(key) - 1):]
+            position += len(block)
+    finally:
+        f.close()
+
+    return _save_index(filename, offsets, save)
+
+def line_frame_offsets(filename, lines_per_frame, save=True):
+    '''Returns the byte offset at which each frame of a text
+       trajectory begins, for formats like xyz where every frame has
+       the same number of lines. The index is persisted as in
+       frame_offsets. A trailing partial frame is not indexed.
+    '''
+    offsets = _load_index(filename)
+    if(offsets is not None):
+        return offsets
+
+    starts = []
+    f = open_text(filename)
+    try:
+        position = 0
+        lines = 0
+        last = '\n'
+        while(True):
+            block = f.read(2 ** 24)
+            if(not block):
+                break
+            last = block[-1]
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            #a frame starts after every lines_per_frame-th newline. The first starts the file
+            ends = newlines[(lines + 1 + np.arange(len(newlines))) % lines_per_frame == 0]
+            starts.extend(position + ends + 1)
+            lines += len(newlines)
+            position += len(block)
+    finally:
+        f.close()
+
+    #the last line may not end in a newline
+    if(last != '\n'):
+        lines += 1
+    offsets = ([0] + starts)[:lines / lines_per_frame]
+    return _save_index(filename, offsets, save)
+
+
+class XYZIndex(object):
+    '''Random access to the positions of an xyz trajectory, which the
+       MDAnalysis reader can only read forward, with a persisted
+       frame offset index.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open_text(filename)
+        self.numatoms = int(self.file.readline())
+        self.offsets = line_frame_offsets(filename, self.numatoms + 2)
+        self.numframes = len(self.offsets)
+
+    def close(self):
+        self.file.close()
+
+    def read_frame(self, frame, ts):
+        '''Reads the positions of the given frame, counting from 0,
+           into the timestep
+        '''
+        if(frame < 0 or frame >= self.numframes):
+            raise IOError('Frame %d is outside of the %d frames in %s' % (frame, self.numframes, self.filename))
+        self.file.seek(self.offsets[frame])
+        #skip the atom count and comment lines
+        lines = [self.file.readline() for i in range(self.numatoms + 2)][2:]
+        ts._pos[:] = np.array([l.split()[1:4] for l in lines], dtype=np.float32)
+        #frames count from 1, as in the MDAnalysis readers
+        ts.frame = frame + 1
+        return ts
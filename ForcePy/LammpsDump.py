@@ -0,0 +1,68 @@
+import numpy as np
+from ForcePy.FrameIndex import open_text, frame_offsets
+
+
+class LammpsDump(object):
+    '''Reads the forces from a lammps dump, one frame at a time. Each
+       frame is read as a single block and its atom lines are parsed in
+       one call to numpy. Frames can be seeked with the offset index,
+       and gzipped dumps (ending in .gz) are supported.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open_text(filename)
+        self.offsets = frame_offsets(filename)
+        self.numframes = len(self.offsets)
+        #the next frame to be read
+        self.frame = 0
+
+    def seek(self, frame):
+        if(frame < 0 or frame >= self.numframes):
+            raise IndexError('Frame %d is outside of the %d frames in %s' % (frame, self.numframes, self.filename))
+        self.frame = frame
+
+    def rewind(self):
+        self.frame = 0
+
+    def close(self):
+        self.file.close()
+
+    def _read_block(self, frame):
+        self.file.seek(self.offsets[frame])
+        if(frame + 1 < self.numframes):
+            return self.file.read(self.offsets[frame + 1] - self.offsets[frame])
+        return self.file.read()
+
+    def read_forces(self, forces):
+        '''Reads the next frame into forces, indexed by lammps atom id
+           minus one. Lammps forces are the negative of the forces used here.
+        '''
+        if(self.frame >= self.numframes):
+            raise IOError('Reached the end of %s' % self.filename)
+        block = self._read_block(self.frame)
+
+        #header up to the atoms
+        count_start = block.find('ITEM: NUMBER OF ATOMS')
+        atoms_start = block.find('ITEM: ATOMS')
+        if(count_start == -1 or atoms_start == -1):
+            raise IOError('Could not find the atoms of frame %d in %s' % (self.frame, self.filename))
+        N = int(block[count_start:atoms_start].split('\n')[1])
+        header_end = block.find('\n', atoms_start)
+        columns = block[atoms_start:header_end].split()[2:]
+
+        values = np.fromstring(block[header_end + 1:], dtype=np.float64, sep=' ')
+        if(len(values) != N * len(columns)):
+            raise IOError('Invalid forces in frame %d of %s. Expected %d values and found %d' % (self.frame, self.filename, N * len(columns), len(values)))
+        values = values.reshape( (N, len(columns)) )
+
+        #without named columns, assume the order id fx fy fz
+        ids = values[:, columns.index('id') if 'id' in columns else 0].astype(np.int64) - 1
+        if('fx' in columns):
+            fcols = [columns.index(c) for c in ('fx', 'fy', 'fz')]
+        else:
+            fcols = [1, 2, 3]
+
+        forces[ids] = -values[:, fcols]
+        self.frame += 1
+        return forces
@@ -36,6 +36,13 @@ cdef class UniformMesh(object):
         assert x >= self.l and x < self.r, "Mesh point is not within mesh"
         return max(0, min(self.length - 1, int(floor( (x - self.l) / self.__dx) )))
 
+    def mesh_indices(self, x):
+        """mesh_index for each element of an array
+        """
+        x = np.asarray(x, dtype=FTYPE)
+        assert np.all(x >= self.l) and np.all(x < self.r), "Mesh point is not within mesh"
+        return np.clip(np.floor((x - self.l) / self.__dx), 0, self.length - 1).astype(np.int32)
+
     def __len__(self):
         return self.length
 
@@ -1,13 +1,11 @@
 # cython: profile=False
 # filename: NeighborList.pyx
 
-import pstats, cProfile
 import numpy as np
 cimport numpy as np
 import cython
-import time
-from libc.stdlib cimport malloc, free
-from libc.math cimport ceil, floor, sqrt
+from cython.parallel cimport prange
+from libc.math cimport ceil, floor, sqrt, M_PI
 
 
 DTYPE = np.int32
@@ -16,174 +14,321 @@ ctypedef np.int32_t DTYPE_t
 FTYPE = np.float32
 ctypedef np.float32_t FTYPE_t
 
-cdef FTYPE_t cround(FTYPE_t x):
-    return ceil(x - 0.5) if x < 0. else floor(x + 0.5)        
+#at most 3 x 3 x 3 neighboring cells, including the cell itself
+DEF MAX_CELL_NEIGHBORS = 27
+#head room on the estimated number of pairs so that most frames never resize
+DEF NLIST_SAFETY = 1.25
+
+#omp.h if the extension is built with OpenMP, otherwise a serial stand-in
+cdef extern from "omp_compat.h":
+    int omp_get_max_threads() nogil
+
+cdef inline double cround(double x) nogil:
+    return ceil(x - 0.5) if x < 0. else floor(x + 0.5)
 
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
-cdef FTYPE_t min_img_dist_sq(np.ndarray[FTYPE_t, ndim=1] x, np.ndarray[FTYPE_t, ndim=1] y, double* img, bint periodic=True):
-    cdef FTYPE_t dx
-    cdef FTYPE_t dist = 0
-    cdef int i
-    for i in range(3):
-        dx = x[i] - y[i]        
+@cython.wraparound(False)
+cdef inline double min_img_dist_sq(FTYPE_t[:, ::1] positions, int i, int j, double* img, bint periodic) nogil:
+    cdef double dx
+    cdef double dist = 0
+    cdef int k
+    for k in range(3):
+        dx = positions[i, k] - positions[j, k]
         if(periodic):
-            dx -= cround(dx / img[i]) * img[i]
+            dx -= cround(dx / img[k]) * img[k]
         dist += dx * dx
     return dist
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint is_excluded(DTYPE_t[::1] offsets, DTYPE_t[::1] exclusions, int i, int j) nogil:
+    #binary search of the sorted exclusions of i
+    cdef int lo = offsets[i]
+    cdef int hi = offsets[i + 1]
+    cdef int mid
+    while(lo < hi):
+        mid = (lo + hi) / 2
+        if(exclusions[mid] < j):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo < offsets[i + 1] and exclusions[lo] == j
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int pair_search(int i, FTYPE_t[:, ::1] positions, double* box, bint periodic, double cutoff_sq,
+                     DTYPE_t[::1] atom_cell, DTYPE_t[:, ::1] cell_neighbors, DTYPE_t[::1] cell_neighbor_count,
+                     DTYPE_t[::1] head, DTYPE_t[::1] cells,
+                     DTYPE_t[::1] exclusion_offsets, DTYPE_t[::1] exclusions, DTYPE_t* out) nogil:
+    #find the neighbors of i. They are written to out unless it is NULL. Returns the count
+    cdef int j, k, ncell
+    cdef int icell = atom_cell[i]
+    cdef int count = 0
+    for k in range(cell_neighbor_count[icell]):
+        ncell = cell_neighbors[icell, k]
+        j = head[ncell]
+        while(j != - 1):
+            if(i != j and
+               not is_excluded(exclusion_offsets, exclusions, i, j) and
+               min_img_dist_sq(positions, i, j, box, periodic) < cutoff_sq):
+                if(out != NULL):
+                    out[count] = j
+                count += 1
+            j = cells[j]
+    return count
+
+
 cdef class NeighborList(object):
-    """Neighbor list class
+    """Neighbor list class. If a skin is given, the list is built
+       with cutoff + skin and reused on later frames until some
+       particle has moved more than skin / 2 since the last build.
+       The list is built with num_threads OpenMP threads, all
+       available threads by default.
     """
     cdef double cutoff
-    cdef double* box
+    cdef double box[3]
     cdef nlist_lengths
+    cdef DTYPE_t[::1] nlist_offsets
     cdef nlist
-    cdef int* cell_number
-    cdef cell_neighbors #use python object for simplicity and since this isn't yet a bottleneck
-    cdef int* cells 
-    cdef int* head
-    cdef exclusion_list
+    cdef int cell_number[3]
     cdef int cell_number_total
+    #cell neighbor offsets, cell_neighbor_count[c] valid entries per row
+    cdef DTYPE_t[:, ::1] cell_neighbors
+    cdef DTYPE_t[::1] cell_neighbor_count
+    #linked list of particles in each cell
+    cdef DTYPE_t[::1] cells
+    cdef DTYPE_t[::1] head
+    cdef DTYPE_t[::1] atom_cell
+    #exclusions in CSR format, sorted for each particle
+    cdef DTYPE_t[::1] exclusion_offsets
+    cdef DTYPE_t[::1] exclusions
+    cdef bint exclusions_ready
     cdef bint exclude_14
-    
-    
-    def __init__(self, u, cutoff, exclude_14 = True):
-        
+    #Verlet skin. The list is built out to cutoff + skin and is only
+    #rebuilt once a particle has moved more than skin / 2
+    cdef readonly double skin
+    cdef last_positions
+    cdef int nlist_count
+    cdef readonly int build_count
+    cdef readonly int reuse_count
+    #largest number of bytes held by the list buffers
+    cdef readonly long peak_memory
+    cdef readonly int num_threads
+
+
+    def __init__(self, u, cutoff, exclude_14 = True, skin = 0., num_threads = 0):
+
         #set up cell number and data
-        
+
         self.cutoff = cutoff
-        self.box = <double* > malloc(3 * sizeof(double))
-        self.cell_number = <int* > malloc(3 * sizeof(int))
+        self.skin = skin
+        self.last_positions = None
+        self.nlist_count = 0
+        self.build_count = 0
+        self.reuse_count = 0
+        self.num_threads = num_threads if num_threads > 0 else omp_get_max_threads()
         self.cell_number_total = 1
-        cdef i
+        cdef int i
         for i in range(3):
             self.box[i] = u.dimensions[i]
-            self.cell_number[i] = max(1,int(self.box[i] / self.cutoff))
+            self.cell_number[i] = max(1,int(self.box[i] / (self.cutoff + self.skin)))
             self.cell_number_total *= self.cell_number[i]
 
-        self.nlist_lengths = [0 for x in range(u.atoms.numberOfAtoms())]
-        self.nlist = np.arange(u.atoms.numberOfAtoms() * (u.atoms.numberOfAtoms() - 1), dtype=DTYPE)
+        self.nlist_lengths = np.zeros(u.atoms.numberOfAtoms(), dtype=DTYPE)
+        self.nlist_offsets = np.zeros(u.atoms.numberOfAtoms() + 1, dtype=DTYPE)
+        #size the pair buffer from the density and cutoff volume, it grows if it overflows
+        self.nlist = np.empty(self._estimate_pairs(u), dtype=DTYPE)
 
-        self.cells = <int* > malloc(u.atoms.numberOfAtoms() * sizeof(int))
-        self.head = <int*> malloc(self.cell_number_total  * sizeof(int))
-        self.exclusion_list = None
+        self.cells = np.empty(u.atoms.numberOfAtoms(), dtype=DTYPE)
+        self.atom_cell = np.empty(u.atoms.numberOfAtoms(), dtype=DTYPE)
+        self.head = np.empty(self.cell_number_total, dtype=DTYPE)
+        self.exclusions_ready = False
         self.exclude_14 = exclude_14
+        self.peak_memory = 0
 
-        #pre-compute neighbors. Waste of space, but saves programming effort required for ghost cellls        
-        self.cell_neighbors = [[] for x in range(self.cell_number_total)]
+        #pre-compute neighbors. Waste of space, but saves programming effort required for ghost cellls
+        self.cell_neighbors = np.empty((self.cell_number_total, MAX_CELL_NEIGHBORS), dtype=DTYPE)
+        self.cell_neighbor_count = np.zeros(self.cell_number_total, dtype=DTYPE)
         #Leaving all this stuff as python objects because speed is not an issue here
         for xi in range(self.cell_number[0]):
             for yi in range(self.cell_number[1]):
                 for zi in range(self.cell_number[2]):
                     #get neighbors
-                    index = (xi * self.cell_number[0] + yi) * self.cell_number[1] + zi
+                    index = self._cell_index(xi, yi, zi)
                     index_vector = [xi, yi, zi]
                     neighs = [[] for x in range(3)]
                     for i in range(3):
                         neighs[i] = [self.cell_number[i] - 1 if index_vector[i] == 0 else index_vector[i] - 1,
                                      index_vector[i],
                                      0 if index_vector[i] == self.cell_number[i] - 1 else index_vector[i] + 1]
+                    found = []
                     for xd in neighs[0]:
                         for yd in neighs[1]:
                             for zd in neighs[2]:
-                                neighbor = xd * self.cell_number[0] ** 2 + \
-                                                                       yd * self.cell_number[1]  + \
-                                                                       zd
+                                neighbor = self._cell_index(xd, yd, zd)
                                 #check if neighbor is already in cell_neighbor
                                 #this is possible if wrapped and cell number is 1
-                                if(not neighbor in self.cell_neighbors[index]): 
-                                    self.cell_neighbors[index].append(neighbor)
-                        
-    def __del__(self):
-        free(self.box)
-        free(self.cell_number)
-        free(self.head)
-        free(self.cells)
+                                if(not neighbor in found):
+                                    self.cell_neighbors[index, len(found)] = neighbor
+                                    found.append(neighbor)
+                    self.cell_neighbor_count[index] = len(found)
+
+    cdef long _estimate_pairs(self, u) except? -1:
+        cdef long n = u.atoms.numberOfAtoms()
+        cdef double box_volume = self.box[0] * self.box[1] * self.box[2]
+        #without a box there is no density to go on, so start small and let _grow_nlist resize
+        if(box_volume <= 0):
+            return n
+        cdef double density = n / box_volume
+        cdef double volume = 4. / 3. * M_PI * (self.cutoff + self.skin) ** 3
+        return max(n, min(n * (n - 1), <long> (NLIST_SAFETY * n * density * volume)))
+
+    cdef _grow_nlist(self, long count, long needed):
+        #geometric growth, keeping the pairs written so far
+        new_nlist = np.empty(max(needed, 2 * self.nlist.shape[0]), dtype=DTYPE)
+        new_nlist[:count] = self.nlist[:count]
+        self.nlist = new_nlist
+        self._track_memory()
+
+    cdef _track_memory(self):
+        self.peak_memory = max(self.peak_memory, self.memory_usage())
+
+    def memory_usage(self):
+        """Returns the number of bytes currently held by the neighbor list buffers
+        """
+        total = self.nlist.nbytes + self.nlist_lengths.nbytes
+        for a in (self.nlist_offsets, self.cells, self.head, self.atom_cell, self.cell_neighbors, self.cell_neighbor_count):
+            total += a.nbytes
+        if(self.exclusions_ready):
+            total += self.exclusion_offsets.nbytes + self.exclusions.nbytes
+        return total
+
+    cdef int _cell_index(self, int xi, int yi, int zi):
+        return (xi * self.cell_number[1] + yi) * self.cell_number[2] + zi
 
     @cython.boundscheck(False) #turn off bounds checking
-    cdef bin_particles(self, u):
-        cdef int i,j,icell
-        cdef double k
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void bin_particles(self, FTYPE_t[:, ::1] positions) nogil:
+        cdef int i,j,icell,c
         for i in range(self.cell_number_total):
             self.head[i] = -1
 
-        positions = u.atoms.get_positions(copy=False)
-        for i in range(u.atoms.numberOfAtoms()):
+        for i in range(positions.shape[0]):
 
             icell = 0
             #fancy index and binning loop over dimensions
             for j in range(3):
+                #a single cell, which also covers universes without a box, leaves icell as is
+                if(self.cell_number[j] == 1):
+                    continue
                 #sometimes things are unwrapped, better to assume they aren't
-                k = positions[i][j]/ self.box[j] * self.cell_number[j]
-                k = floor(k % self.cell_number[j])      
-                icell =  <int> k + icell * self.cell_number[j]
+                c = <int> floor(positions[i, j] / self.box[j] * self.cell_number[j]) % self.cell_number[j]
+                if(c < 0):
+                    c += self.cell_number[j]
+                icell = c + icell * self.cell_number[j]
+            self.atom_cell[i] = icell
             #push what is on the head into the cells
-
             self.cells[i] = self.head[icell]
             #add current value
             self.head[icell] = i
 
 
     cdef _build_exclusion_list(self, u):
-        #what we're building
-        self.exclusion_list = [[] for x in range(u.atoms.numberOfAtoms())]
-        #The exclusion list at the most recent depth
-        temp_list = [[] for x in range(u.atoms.numberOfAtoms())]
+        cdef int a, n
+        n = u.atoms.numberOfAtoms()
         #build 1,2 terms
+        bonded = [set() for x in range(n)]
         for b in u.bonds:
-            self.exclusion_list[b.atom1.number].append(b.atom2.number)
-            self.exclusion_list[b.atom2.number].append(b.atom1.number)
-        # build 1,3 and 1,4
-        for i in range( 1 if self.exclude_14 else 2):
-            #copy
-            temp_list[:] = self.exclusion_list[:]
-            for a in range(u.atoms.numberOfAtoms()):
-                for b in range(len(temp_list[a])):
-                    self.exclusion_list[a].append(b) 
+            bonded[b.atom1.number].add(b.atom2.number)
+            bonded[b.atom2.number].add(b.atom1.number)
+        # build 1,3 and optionally 1,4 by walking out along the bonds
+        excluded = [set(x) for x in bonded]
+        frontier = [set(x) for x in bonded]
+        for depth in range(2 if self.exclude_14 else 1):
+            for a in range(n):
+                frontier[a] = set([c for b in frontier[a] for c in bonded[b]]) - excluded[a]
+                frontier[a].discard(a)
+                excluded[a] |= frontier[a]
+
+        #flatten into CSR format
+        offsets = np.zeros(n + 1, dtype=DTYPE)
+        offsets[1:] = np.cumsum([len(x) for x in excluded])
+        exclusions = np.empty(max(1, offsets[n]), dtype=DTYPE)
+        for a in range(n):
+            exclusions[offsets[a]:offsets[a + 1]] = sorted(excluded[a])
+        self.exclusion_offsets = offsets
+        self.exclusions = exclusions
+        self.exclusions_ready = True
 
     @cython.boundscheck(False) #turn off bounds checking
     @cython.wraparound(False) #turn off negative indices
-    cdef int _build_nlist(self, u):
+    cdef int _build_nlist(self, u) except -1:
 
-
-        if(self.exclusion_list == None):
+        if(not self.exclusions_ready):
             self._build_exclusion_list(u)
 
-        #bin the particles
-        self.bin_particles(u)
+        cdef FTYPE_t[:, ::1] positions = np.ascontiguousarray(u.atoms.get_positions(copy=False), dtype=FTYPE)
+        cdef DTYPE_t[::1] nlist
+        cdef DTYPE_t[::1] nlist_lengths = self.nlist_lengths
+        cdef DTYPE_t[::1] offsets = self.nlist_offsets
+        cdef bint periodic = u.trajectory.periodic
+        cdef double cutoff_sq = (self.cutoff + self.skin) ** 2
+        cdef int i, n, nlist_count
+        n = positions.shape[0]
 
-        ntime = time.time()
-        positions = u.atoms.get_positions(copy=False)
-                                                                        
-        cdef int i, j, nlist_count, icell
-        cdef double k
-        nlist_count = 0
-        for i in range(u.atoms.numberOfAtoms()):
-            self.nlist_lengths[i] = 0
-
-        periodic = u.trajectory.periodic
-        for i in range(u.atoms.numberOfAtoms()):
-            icell = 0
-            #fancy indepx and binning loop over dimensions
-            for j in range(3):
-                #sometimes things are unwrapped, better to assume they aren't
-                k = positions[i][j]/ self.box[j] * self.cell_number[j]
-                k = floor(k % self.cell_number[j])      
-                icell =  int(k) + icell * self.cell_number[j]
-            for ncell in self.cell_neighbors[icell]:
-                j = self.head[ncell]
-                while(j != - 1):
-                    if(i != j and
-                       not (j in self.exclusion_list[i]) and
-                       min_img_dist_sq(positions[i], positions[j], self.box, periodic) < self.cutoff ** 2):
-                        self.nlist[nlist_count] = j
-                        self.nlist_lengths[i] += 1
-                        nlist_count += 1
-                    j = self.cells[j]
+        #the build is two passes over the particles. First count the
+        #neighbors of each particle, then the prefix sum of the counts
+        #gives each particle its own slice of the list to fill. Both
+        #passes are split over threads.
+        with nogil:
+            #bin the particles
+            self.bin_particles(positions)
+
+            for i in prange(n, schedule='guided', num_threads=self.num_threads):
+                nlist_lengths[i] = pair_search(i, positions, self.box, periodic, cutoff_sq,
+                                               self.atom_cell, self.cell_neighbors, self.cell_neighbor_count,
+                                               self.head, self.cells,
+                                               self.exclusion_offsets, self.exclusions, NULL)
+            offsets[0] = 0
+            for i in range(n):
+                offsets[i + 1] = offsets[i] + nlist_lengths[i]
+            nlist_count = offsets[n]
+
+        if(nlist_count > self.nlist.shape[0]):
+            self._grow_nlist(0, nlist_count)
+        nlist = self.nlist
 
+        with nogil:
+            for i in prange(n, schedule='guided', num_threads=self.num_threads):
+                pair_search(i, positions, self.box, periodic, cutoff_sq,
+                            self.atom_cell, self.cell_neighbors, self.cell_neighbor_count,
+                            self.head, self.cells,
+                            self.exclusion_offsets, self.exclusions, &nlist[offsets[i]])
+
+        self._track_memory()
         return nlist_count
 
-    def build_nlist(self, u):        
-        return self.nlist[:self._build_nlist(u)], self.nlist_lengths
+    def _needs_rebuild(self, u):
+        if(self.skin <= 0 or self.last_positions is None):
+            return True
+        positions = u.atoms.get_positions(copy=False)
+        dx = positions - self.last_positions
+        if(u.trajectory.periodic):
+            box = np.asarray([self.box[0], self.box[1], self.box[2]], dtype=FTYPE)
+            dx -= np.round(dx / box) * box
+        #rebuild once any particle may have crossed into the cutoff from outside the skin
+        return np.max(np.sum(dx * dx, axis=1)) > (0.5 * self.skin) ** 2
+
+    def build_nlist(self, u):
+        if(self._needs_rebuild(u)):
+            self.nlist_count = self._build_nlist(u)
+            self.build_count += 1
+            if(self.skin > 0):
+                self.last_positions = np.array(u.atoms.get_positions(copy=False), dtype=FTYPE)
+        else:
+            self.reuse_count += 1
+        return self.nlist[:self.nlist_count], self.nlist_lengths
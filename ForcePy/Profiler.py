@@ -0,0 +1,72 @@
+import time, json
+
+
+class Profiler(object):
+    '''Accumulates the wall time spent in each stage of force matching,
+       along with the number of frames and neighbor pairs processed. If
+       a stream (file name or file object) is given, a JSON summary is
+       appended to it as one line every `every` frames.
+    '''
+
+    def __init__(self, stream = None, every = 100):
+        self.stream = stream
+        self.every = every
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.started = {}
+        self.frames = 0
+        self.pairs = 0
+        self.start_time = time.time()
+
+    def start(self, stage):
+        self.started[stage] = time.time()
+
+    def stop(self, stage, calls = 1):
+        self.add(stage, time.time() - self.started.pop(stage), calls)
+
+    def add(self, stage, seconds, calls = 1):
+        self.times[stage] = self.times.get(stage, 0.) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def frame(self, pairs = 0):
+        '''Counts a completed frame and the pairs evaluated in it
+        '''
+        self.frames += 1
+        self.pairs += pairs
+        if(self.stream is not None and self.every and self.frames % self.every == 0):
+            self.write(self.stream)
+
+    def summary(self):
+        wall = max(time.time() - self.start_time, 1e-9)
+        stages = {}
+        for s in self.times:
+            stages[s] = {'time': self.times[s], 'calls': self.calls[s], 'fraction': self.times[s] / wall}
+        return {'wall_time': wall, 'frames': self.frames, 'pairs': self.pairs,
+                'frames_per_second': self.frames / wall, 'pairs_per_second': self.pairs / wall,
+                'stages': stages}
+
+    def write(self, stream):
+        '''Appends the summary as a line of JSON
+        '''
+        if(type(stream) == str):
+            with open(stream, 'a') as f:
+                f.write(json.dumps(self.summary()) + '\n')
+        else:
+            stream.write(json.dumps(self.summary()) + '\n')
+            stream.flush()
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def __str__(self):
+        s = self.summary()
+        lines = ['%-16s %10s %8s %7s' % ('stage', 'time (s)', 'calls', '%')]
+        for k in sorted(s['stages'], key=lambda x: -s['stages'][x]['time']):
+            v = s['stages'][k]
+            lines.append('%-16s %10.3f %8d %7.1f' % (k, v['time'], v['calls'], 100 * v['fraction']))
+        lines.append('%d frames in %.3f s, %.3g frames/s, %.3g pairs/s' % (s['frames'], s['wall_time'], s['frames_per_second'], s['pairs_per_second']))
+        return '\n'.join(lines)
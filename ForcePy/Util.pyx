@@ -9,7 +9,10 @@ from libc.math cimport ceil, floor, sqrt
 FTYPE = np.float32
 ctypedef np.float32_t FTYPE_t
 
-cdef FTYPE_t cround(FTYPE_t x):
+DTYPE = np.int32
+ctypedef np.int32_t DTYPE_t
+
+cdef FTYPE_t cround(FTYPE_t x) nogil:
     return ceil(x - 0.5) if x < 0. else floor(x + 0.5)        
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
@@ -32,6 +35,20 @@ def same_img(np.ndarray[FTYPE_t, ndim=1] x, np.ndarray[FTYPE_t, ndim=1] y, np.nd
         x[i] -= cround(dx / img[i]) * img[i]
     return x
 
+#put every particle into the same image as its anchor particle. The positions
+#are strided since the MDAnalysis timesteps store them in fortran order
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def same_img_array(FTYPE_t[:, :] positions, DTYPE_t[::1] anchor, FTYPE_t[::1] img):
+    cdef FTYPE_t dx
+    cdef int i, k
+    with nogil:
+        for i in range(positions.shape[0]):
+            for k in range(3):
+                dx = positions[i,k] - positions[anchor[i],k]
+                positions[i,k] -= cround(dx / img[k]) * img[k]
+    return positions
+
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 def min_img(np.ndarray[FTYPE_t, ndim=1] x, np.ndarray[FTYPE_t, ndim=1] img, bint periodic=True):
     cdef int i
@@ -58,10 +75,55 @@ def min_img_dist(np.ndarray[FTYPE_t, ndim=1] x, np.ndarray[FTYPE_t, ndim=1] y, n
 cpdef double norm3(np.ndarray[FTYPE_t, ndim=1] x):
     return sqrt(x[0] * x[0] + x[1] * x[1] + x[2] * x[2])
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
 def spec_force_inner_loop(np.ndarray[FTYPE_t, ndim=1] w, np.ndarray[FTYPE_t, ndim=1] basis_out, 
                           np.ndarray[FTYPE_t, ndim=2] grad, np.ndarray[FTYPE_t, ndim=1] force, 
-                          np.ndarray[FTYPE_t, ndim=1] r):
-    for i in range(w.shape[0]):
-        for j in range(r.shape[0]):
-            force[j] = force[j] + w[i] * basis_out[i] * r[j]
-            grad[i,j] = basis_out[i] * r[j] + grad[i,j]
+                          np.ndarray[FTYPE_t, ndim=1] r, int start = 0):
+    #basis_out holds the basis values from mesh index start onwards
+    cdef int i, j, k
+    cdef FTYPE_t b
+    for k in range(basis_out.shape[0]):
+        i = start + k
+        b = basis_out[k]
+        for j in range(3):
+            force[j] = force[j] + w[i] * b * r[j]
+            grad[i,j] = b * r[j] + grad[i,j]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def neighbor_vecs(FTYPE_t[:, ::1] positions, FTYPE_t[::1] img, bint periodic,
+                  DTYPE_t[::1] nlist, DTYPE_t[::1] nlist_offsets, int start, int end, double cutoff = 0):
+    """Computes the neighbor vectors of particles start to end - 1 in
+       one pass over the neighbor list. Returns the arrays (i, j, r, d)
+       with one entry per pair, where r is the unit vector from i to j
+       and d is the distance. If cutoff is positive, pairs at or
+       beyond it are skipped.
+    """
+    cdef int length = nlist_offsets[end] - nlist_offsets[start]
+    cdef np.ndarray[DTYPE_t, ndim=1] i_out = np.empty(length, dtype=DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=1] j_out = np.empty(length, dtype=DTYPE)
+    cdef np.ndarray[FTYPE_t, ndim=2] r_out = np.empty((length, 3), dtype=FTYPE)
+    cdef np.ndarray[np.float64_t, ndim=1] d_out = np.empty(length, dtype=np.float64)
+    cdef FTYPE_t dx[3]
+    cdef double d
+    cdef int i, j, k, l, count = 0
+
+    for i in range(start, end):
+        for k in range(nlist_offsets[i], nlist_offsets[i + 1]):
+            j = nlist[k]
+            for l in range(3):
+                dx[l] = positions[j, l] - positions[i, l]
+                if(periodic):
+                    dx[l] -= cround(dx[l] / img[l]) * img[l]
+            d = sqrt(dx[0] * dx[0] + dx[1] * dx[1] + dx[2] * dx[2])
+            if(cutoff > 0 and d >= cutoff):
+                continue
+            i_out[count] = i
+            j_out[count] = j
+            for l in range(3):
+                r_out[count, l] = dx[l] / d
+            d_out[count] = d
+            count += 1
+
+    return i_out[:count], j_out[:count], r_out[:count], d_out[:count]
@@ -1,6 +1,6 @@
 from ForcePy.ForceMatch import ForceMatch, Pairwise, Bond
 from ForcePy.Forces import FileForce, AnalyticForce, SpectralForce, SmoothRegularizer, L2Regularizer, LJForce, HarmonicForce, FixedHarmonicForce
 import ForcePy.Mesh as Mesh
-from ForcePy.CGMap import CGUniverse, add_sequential_bonds, add_residue_bonds, write_structure, write_trajectory, write_lammps_data, add_residue_bonds_table
+from ForcePy.CGMap import CGUniverse, add_sequential_bonds, add_residue_bonds, write_structure, write_trajectory, write_lammps_data, add_residue_bonds_table, load_cache
 import ForcePy.Basis
 
@@ -0,0 +1,7 @@
+/* Lets the neighbor list build without OpenMP, in which case the
+   prange loops run serially on one thread */
+#ifdef _OPENMP
+#include <omp.h>
+#else
+static int omp_get_max_threads(void) { return 1; }
+#endif
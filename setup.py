@@ -14,11 +14,14 @@ from ez_setup import use_setuptools
 use_setuptools()
 from setuptools import setup, Extension
 from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
+from distutils.errors import CompileError, LinkError
 #
 #------------------------------------------------------------
 
 import sys, os
 import glob
+import shutil, tempfile
 
 # Make sure I have the right Python version.
 if sys.version_info[:2] < (2, 5):
@@ -60,6 +63,25 @@ if use_cython:
         raise ImportError("Cython version %s (found %s) is required because it offers a handy parallelisation module" % (required_version, Cython.__version__))
     del Cython
 
+def has_openmp():
+    '''Checks that the compiler can build and link a program with -fopenmp
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'omp_test.c')
+        with open(source, 'w') as f:
+            f.write('#include <omp.h>\nint main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n')
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        try:
+            objects = compiler.compile([source], output_dir=tmpdir, extra_postargs=['-fopenmp'])
+            compiler.link_executable(objects, os.path.join(tmpdir, 'omp_test'), extra_postargs=['-fopenmp'])
+        except (CompileError, LinkError):
+            return False
+        return True
+    finally:
+        shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     RELEASE = "0.1" 
     with open("README.md") as summary:
@@ -81,20 +103,29 @@ if __name__ == '__main__':
         extra_compile_args = '\
             -std=c99 -pedantic -Wall -Wcast-align -Wcast-qual -Wpointer-arith \
             -Wchar-subscripts -Winline -Wnested-externs -Wbad-function-cast \
-            -Wunreachable-code -Werror'
+            -Wunreachable-code -Werror'.split()
         define_macros = [('DEBUG', '1')]
     else:
         extra_compile_args = ['-O3']
         define_macros = []
 
+    #the neighbor list is built in parallel with cython.parallel if the compiler has OpenMP
+    if has_openmp():
+        openmp_args = ['-fopenmp']
+    else:
+        print "OpenMP was not found, the neighbor list will be built on one thread"
+        openmp_args = []
+
     extensions = [Extension('ForcePy.Util', ['ForcePy/Util.%s' % ("pyx" if use_cython else "c")],
                             include_dirs=include_dirs ,
                             libraries = ['m'],
                             extra_compile_args=extra_compile_args),
                   Extension('ForcePy.NeighborList', ['ForcePy/NeighborList.%s' % ("pyx" if use_cython else "c")],
                             include_dirs=include_dirs ,
+                            depends = ['ForcePy/omp_compat.h'],
                             libraries = ['m'],
-                            extra_compile_args=extra_compile_args),
+                            extra_compile_args=extra_compile_args + openmp_args,
+                            extra_link_args=openmp_args),
                   Extension('ForcePy.Mesh', ['ForcePy/Mesh.%s' % ("pyx" if use_cython else "c")],
                             include_dirs=include_dirs ,
                             libraries = [],
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+"""
+Times the force matching hot paths on synthetic Lennard-Jones and
+water-like systems. Results are written as JSON and can be compared
+with a stored baseline, eg
+
+    python benchmark.py --sizes 250 1000 4000 --output base.json
+    python benchmark.py --sizes 250 1000 4000 --compare base.json
+
+which exits with status 1 if a benchmark is slower than the baseline
+by more than the tolerance.
+"""
+
+import argparse, json, os, random, shutil, sys, tempfile, time
+import numpy as np
+from MDAnalysis import Universe
+from ForcePy import *
+from ForcePy.ForceCategories import Pairwise
+from ForcePy.NeighborList import NeighborList
+
+#Lennard-Jones density in sigma^-3 and water density in molecules / A^3
+LJ_DENSITY = 0.8
+WATER_DENSITY = 0.0334
+
+
+def write_system(directory, name, atoms, frames, box):
+    '''Writes a pdb and multi-frame xyz for atoms, a list of (atom
+       name, residue name, residue number), and returns a Universe
+    '''
+    pdb = os.path.join(directory, name + '.pdb')
+    xyz = os.path.join(directory, name + '.xyz')
+    with open(pdb, 'w') as f:
+        f.write('CRYST1%9.3f%9.3f%9.3f  90.00  90.00  90.00 P 1           1\n' % (box, box, box))
+        for i,(a,r,k) in enumerate(atoms):
+            x,y,z = frames[0][i]
+            f.write('ATOM  %5d %-4s %-4s %4d    %8.3f%8.3f%8.3f  1.00  0.00\n' % ((i + 1) % 100000, a, r, k % 10000, x, y, z))
+        f.write('END\n')
+    with open(xyz, 'w') as f:
+        for k,p in enumerate(frames):
+            f.write('%d\nFrame: %d\n' % (len(atoms), k))
+            for (a,r,n),x in zip(atoms, p):
+                f.write('%s %12.5f %12.5f %12.5f\n' % (a, x[0], x[1], x[2]))
+    u = Universe(pdb, xyz)
+    u.trajectory.periodic = True
+    #xyz files carry no box
+    set_box(u, box)
+    return u
+
+
+def lattice(n, box, rng):
+    '''n points on a jittered cubic lattice, so no particles overlap
+    '''
+    m = int(np.ceil(n ** (1. / 3)))
+    spacing = box / m
+    grid = np.indices( (m, m, m) ).reshape( (3, -1) ).T[:n] * spacing
+    return (grid + (rng.rand(n, 3) - 0.5) * 0.2 * spacing) % box
+
+
+def lj_system(directory, n, frames, seed = 0):
+    rng = np.random.RandomState(seed)
+    box = (n / LJ_DENSITY) ** (1. / 3)
+    positions = [lattice(n, box, rng) for k in range(frames)]
+    atoms = [('AR', 'LIG', i + 1) for i in range(n)]
+    return write_system(directory, 'lj_%d' % n, atoms, positions, box), box
+
+
+def water_system(directory, n, frames, seed = 0):
+    '''n is the number of molecules
+    '''
+    rng = np.random.RandomState(seed)
+    box = (n / WATER_DENSITY) ** (1. / 3)
+    atoms = []
+    for i in range(n):
+        atoms.extend([('OW', 'SOL', i + 1), ('HW1', 'SOL', i + 1), ('HW2', 'SOL', i + 1)])
+    positions = []
+    for k in range(frames):
+        o = lattice(n, box, rng)
+        p = np.empty( (3 * n, 3) )
+        p[0::3] = o
+        p[1::3] = o + [0.8, 0.6, 0]
+        p[2::3] = o + [-0.8, 0.6, 0]
+        positions.append(p % box)
+    return write_system(directory, 'water_%d' % n, atoms, positions, box), box
+
+
+def set_box(u, box):
+    #strange ordering due to charm, as in ForceMatch
+    u.trajectory.ts._unitcell[0] = box
+    u.trajectory.ts._unitcell[2] = box
+    u.trajectory.ts._unitcell[5] = box
+
+
+def best_time(fxn, repeat):
+    times = []
+    for r in range(repeat):
+        start = time.time()
+        fxn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def run(sizes, frames, repeat, directory):
+    results = {}
+    mesh = Mesh.UniformMesh(0, 2.5, 0.01)
+    for n in sizes:
+        print "system size %d" % n
+        #the category is shared by every pairwise force and its neighbor list is sized for one system
+        Pairwise.instance = None
+        u, box = lj_system(directory, n, frames)
+
+        nlist = NeighborList(u, 2.5)
+        results['nlist_build/%d' % n] = best_time(lambda: nlist.build_nlist(u), repeat)
+
+        lj = LJForce(2.5)
+        lj.setup_hook(u)
+        spectral = SpectralForce(Pairwise, mesh, Basis.Quartic(mesh, 0.05))
+        spectral.setup_hook(u)
+        spectral.w[:] = np.random.RandomState(0).rand(len(spectral.w))
+        category = spectral.category
+        category._setup(u)
+        forces = np.zeros( (n, 3) )
+
+        def particle_forces():
+            for i in range(n):
+                spectral.calc_particle_force(i, u)
+        results['calc_particle_force/%d' % n] = best_time(particle_forces, repeat)
+        results['spectral_calc_forces/%d' % n] = best_time(lambda: spectral.calc_forces(forces, u), repeat)
+        results['lj_calc_forces/%d' % n] = best_time(lambda: lj.calc_forces(forces, u), repeat)
+        category._teardown()
+
+        x = np.random.RandomState(1).rand(n) * 2.4
+        cache = np.zeros(len(mesh), dtype=np.float32)
+        for name,basis in [('UnitStep', Basis.UnitStep), ('Quartic', Basis.Quartic(mesh, 0.05)), ('Gaussian', Basis.Gaussian(mesh, 0.05))]:
+            def basis_cache():
+                for d in x:
+                    basis.force_cache(d, cache, mesh)
+            results['force_cache_%s/%d' % (name, n)] = best_time(basis_cache, repeat)
+
+        #an epoch of force matching on the lj system
+        def epoch():
+            fm = ForceMatch(u)
+            fm.json = {'box': [box, box, box]}
+            fm.plot_frequency = -1
+            fm.add_ref_force(LJForce(2.5))
+            fm.add_and_type_pair(SpectralForce(Pairwise, mesh, Basis.Quartic(mesh, 0.05)))
+            random.seed(0)
+            fm.force_match(minibatch=0)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results['force_match_epoch/%d' % n] = best_time(epoch, repeat)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        #map a water-like system of the same number of atoms to 2 sites
+        w, wbox = water_system(directory, max(1, n / 3), frames)
+        cgu = CGUniverse(w, ['name OW', 'name HW1 or name HW2'], ['O', 'H2'], False)
+        def cg_map():
+            #iterating continues from the current frame
+            cgu.trajectory.rewind()
+            for ts in cgu.trajectory:
+                pass
+        results['cg_map/%d' % n] = best_time(cg_map, repeat)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Prints the ratio of each time to the baseline and returns the
+       names of the benchmarks which are slower by more than tolerance
+    '''
+    regressions = []
+    print "%-32s %10s %10s %8s" % ('benchmark', 'baseline', 'current', 'ratio')
+    for k in sorted(results):
+        if(k not in baseline):
+            print "%-32s %10s %10.4f" % (k, '-', results[k])
+            continue
+        ratio = results[k] / max(baseline[k], 1e-9)
+        flag = ''
+        if(ratio > 1 + tolerance):
+            regressions.append(k)
+            flag = ' slower'
+        print "%-32s %10.4f %10.4f %8.2f%s" % (k, baseline[k], results[k], ratio, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the force matching hot paths')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[250, 1000, 4000], help='number of atoms in each system')
+    parser.add_argument('--frames', type=int, default=5, help='number of frames in each trajectory')
+    parser.add_argument('--repeat', type=int, default=3, help='the best of this many runs is reported')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fraction a benchmark may be slower than the baseline')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = run(args.sizes, args.frames, args.repeat, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    if(args.output):
+        with open(args.output, 'w') as f:
+            json.dump({'sizes': args.sizes, 'frames': args.frames, 'results': results}, f, indent=2, sort_keys=True)
+
+    if(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if(compare(results, baseline, args.tolerance)):
+            sys.exit(1)
+    else:
+        for k in sorted(results):
+            print "%-32s %10.4f" % (k, results[k])
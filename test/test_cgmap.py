@@ -0,0 +1,34 @@
+from MDAnalysis import Universe
+from ForcePy import *
+import numpy as np
+import shutil, tempfile
+from ForcePy.NeighborList import NeighborList
+
+#maps the periodic spc water box to two sites per molecule. Run from the top directory
+aa = Universe("test/water/spc.gro")
+aa.trajectory.periodic = True
+box = np.asarray(aa.trajectory.ts.dimensions[:3], dtype=np.float32)
+cgu = CGUniverse(aa, ['name OW', 'name HW1 or name HW2'], ['O', 'H2'], collapse_hydrogens=False)
+
+#the hydrogen site must sit next to its oxygen, even for molecules split across the box
+positions = cgu.atoms.get_positions()
+d = np.sqrt(np.sum((positions[0::2] - positions[1::2]) ** 2, axis=1))
+assert np.max(d) < 1.5, "CG sites are %g A apart" % np.max(d)
+
+#every atom ends up in the image of the first atom of its residue
+aa_positions = aa.atoms.get_positions()
+dx = aa_positions[1::3] - aa_positions[0::3]
+assert np.all(np.abs(dx) < box / 2)
+print "periodic mapping ok"
+
+#the memory-mapped cache must hold every frame and serve writable positions
+directory = tempfile.mkdtemp()
+try:
+    cached = cgu.cache(directory, mmap=True)
+    assert cached.trajectory.numframes == cgu.trajectory.numframes
+    assert np.allclose(cached.atoms.get_positions(), positions, atol=1e-3)
+    nlist = NeighborList(cached, 5.)
+    assert len(nlist.build_nlist(cached)[0]) > 0
+finally:
+    shutil.rmtree(directory)
+print "mmap cache ok"
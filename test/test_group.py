@@ -0,0 +1,28 @@
+from MDAnalysis import Universe
+from ForcePy import *
+import numpy as np
+from ForcePy.Forces import SpectralForceGroup
+
+#the methanol model has two types, so a pairwise force is cloned for three type pairs. Run from the top directory
+fm = ForceMatch(Universe("test/methanol/cg.pdb", "test/methanol/cg.xyz"))
+fm.u.trajectory.periodic = False
+mesh = Mesh.UniformMesh(0, 15, 0.05)
+fm.add_and_type_pair(SpectralForce(Pairwise, mesh, Basis.Quartic(mesh, 0.5)))
+
+#the clones must be evaluated together by one group
+calls = fm._particle_forces(fm.tar_forces)
+assert len(fm.tar_forces) == 3, "%d clones" % len(fm.tar_forces)
+assert len(calls) == 1 and isinstance(calls[0], SpectralForceGroup)
+assert all([f.force_group is calls[0] for f in fm.tar_forces])
+
+#and give the same forces as evaluating them one at a time
+rng = np.random.RandomState(0)
+for f in fm.tar_forces:
+    f.w[:] = rng.rand(len(f.w))
+fm._setup()
+for i in range(0, fm.u.atoms.numberOfAtoms(), 50):
+    grouped = np.copy(calls[0].calc_particle_force(i, fm.u))
+    separate = np.sum([np.copy(f.calc_particle_force(i, fm.u)) for f in fm.tar_forces], axis=0)
+    assert np.allclose(grouped, separate, rtol=1e-4, atol=1e-4), "particle %d: %s != %s" % (i, grouped, separate)
+fm._teardown()
+print "grouped evaluation ok"